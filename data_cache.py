@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+CACHE_FORMAT_VERSION = 2
+
+# name -> dtype of every array saved in a compiled cache directory
+ARRAY_DTYPE_DIC = {
+    "ID": np.int64,
+    "tokens": np.int32,
+    "token_offsets": np.int64,
+    "entity_spans": np.int32,  # [number of entity, 2], (start, end) with end included
+    "entity_types": np.int16,  # index in entity_type_list, -1 when the entity has no type
+    "entity_offsets": np.int64,
+    "relation_pairs": np.int32,  # [number of relation, 3], (relation index, entity index, entity index)
+    "relation_offsets": np.int64,
+}
+
+
+def file_sha1(file, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_cache_dir(json_file, source_sha1, entity_type_list, relation_list):
+    # named after everything the cache is compiled from, so a cache directory is never replaced once written and a
+    # run never has the cache it is opening removed by another run
+    cache_key = hashlib.sha1(json.dumps([CACHE_FORMAT_VERSION, source_sha1, list(entity_type_list),
+                                         list(relation_list)]).encode("utf-8")).hexdigest()
+    return os.path.splitext(json_file)[0] + "_compiled_" + cache_key[:16]
+
+
+def parse_span(span_str):
+    # "[3, 4, 5]" or "([3, 4], [7, 8])"
+    return json.loads(span_str.replace("(", "[").replace(")", "]"))
+
+
+def compile_model_data(json_file, cache_dir, entity_type_list, relation_list, source_sha1):
+    entity_type_index_dic = {entity_type: index for index, entity_type in enumerate(entity_type_list)}
+
+    ID_list = []
+    tokens = []
+    token_offsets = [0]
+    entity_spans = []
+    entity_types = []
+    entity_offsets = [0]
+    relation_pairs = []
+    relation_offsets = [0]
+
+    with open(json_file, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            ID_list.append(int(record["ID"]))
+            tokens.extend(record["tokens"])
+            token_offsets.append(len(tokens))
+
+            sent_entity_list = sorted((parse_span(span) for span in record["sep_entity"]), key=lambda s: s[0])
+            span_to_index_dic = {}
+            for index, span in enumerate(sent_entity_list):
+                if span != list(range(span[0], span[-1] + 1)):
+                    raise Exception(f"Entity span is not continuous in example {record['ID']}: {span}")
+                # the entity markers and the pair order both need entities one after the other
+                if index > 0 and span[0] <= sent_entity_list[index - 1][-1]:
+                    raise Exception(f"Entity spans overlap in example {record['ID']}: "
+                                    f"{sent_entity_list[index - 1]} {span}")
+                span_to_index_dic[tuple(span)] = len(span_to_index_dic)
+
+            # the first entity type (in entity_type_list order) containing the span wins
+            sent_entity_type_list = [-1] * len(sent_entity_list)
+            for entity_type in reversed(entity_type_list):
+                for span in record.get(entity_type, []):
+                    index = span_to_index_dic.get(tuple(parse_span(span)))
+                    if index is not None:
+                        sent_entity_type_list[index] = entity_type_index_dic[entity_type]
+
+            for span, entity_type in zip(sent_entity_list, sent_entity_type_list):
+                entity_spans.append((span[0], span[-1]))
+                entity_types.append(entity_type)
+            entity_offsets.append(len(entity_spans))
+
+            for relation_index, relation in enumerate(relation_list):
+                sent_pair_list = []
+                for pair in record.get(relation, []):
+                    entity_1, entity_2 = sorted(parse_span(pair))
+                    if tuple(entity_1) not in span_to_index_dic or tuple(entity_2) not in span_to_index_dic:
+                        raise Exception(f"Relation span is not in sep_entity of example {record['ID']}: {pair}")
+                    if entity_1 == entity_2:
+                        raise Exception(f"Relation between an entity and itself in example {record['ID']}: {pair}")
+                    # (smaller entity index, larger entity index), the order of the pairs of the dataset
+                    index_pair = tuple(sorted((span_to_index_dic[tuple(entity_1)], span_to_index_dic[tuple(entity_2)])))
+                    if index_pair not in sent_pair_list:
+                        sent_pair_list.append(index_pair)
+                relation_pairs.extend((relation_index, i, j) for i, j in sent_pair_list)
+            relation_offsets.append(len(relation_pairs))
+
+    array_dic = {
+        "ID": ID_list,
+        "tokens": tokens,
+        "token_offsets": token_offsets,
+        "entity_spans": np.array(entity_spans).reshape(-1, 2),
+        "entity_types": entity_types,
+        "entity_offsets": entity_offsets,
+        "relation_pairs": np.array(relation_pairs).reshape(-1, 3),
+        "relation_offsets": relation_offsets,
+    }
+    meta_dic = {
+        "format_version": CACHE_FORMAT_VERSION,
+        "source_sha1": source_sha1,
+        "entity_type_list": list(entity_type_list),
+        "relation_list": list(relation_list),
+        "num_examples": len(ID_list),
+    }
+
+    # write everything into a temporary folder first, so a reader never sees a half written cache
+    parent_dir = os.path.dirname(os.path.abspath(cache_dir))
+    os.makedirs(parent_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(prefix=".compiling_", dir=parent_dir)
+    try:
+        for name, dtype in ARRAY_DTYPE_DIC.items():
+            np.save(os.path.join(temp_dir, name + ".npy"), np.asarray(array_dic[name], dtype=dtype))
+        with open(os.path.join(temp_dir, "meta.json"), "w") as f:
+            json.dump(meta_dic, f)
+
+        try:
+            os.rename(temp_dir, cache_dir)
+        except OSError:
+            # another run has just finished compiling the same file
+            if read_cache_meta(cache_dir) != meta_dic:
+                raise
+    finally:
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def read_cache_meta(cache_dir):
+    meta_file = os.path.join(cache_dir, "meta.json")
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, "r") as f:
+        return json.load(f)
+
+
+class CompiledModelData:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.meta = read_cache_meta(cache_dir)
+        self.entity_type_list = self.meta["entity_type_list"]
+        self.relation_list = self.meta["relation_list"]
+        for name in ARRAY_DTYPE_DIC.keys():
+            setattr(self, name, np.load(os.path.join(cache_dir, name + ".npy"), mmap_mode="r"))
+
+    def __len__(self):
+        return len(self.ID)
+
+    def get_tokens(self, index):
+        return self.tokens[self.token_offsets[index]:self.token_offsets[index + 1]]
+
+    def get_entity_spans(self, index):
+        return self.entity_spans[self.entity_offsets[index]:self.entity_offsets[index + 1]]
+
+    def get_entity_types(self, index):
+        return self.entity_types[self.entity_offsets[index]:self.entity_offsets[index + 1]]
+
+    def get_relation_pairs(self, index):
+        return self.relation_pairs[self.relation_offsets[index]:self.relation_offsets[index + 1]]
+
+    def build_marked_tokens(self, start_marker_ids, end_marker_ids):
+        # every entity is wrapped by the markers of its type: ... [Entity_Drug] tokens [/Entity_Drug] ...
+        # the marker ids are indexed by entity type, the last one is used by entities without type (-1)
+        # returns the marked tokens, their offsets and the (start marker, end marker) position of every entity
+        entity_example = np.repeat(np.arange(len(self)), np.diff(self.entity_offsets))
+        entity_rank = np.arange(len(self.entity_spans)) - self.entity_offsets[entity_example]
+
+        marked_token_offsets = self.token_offsets + 2 * self.entity_offsets
+        # entities are sorted, the k-th entity is shifted by the 2 * k markers in front of it
+        marked_entity_spans = self.entity_spans + 2 * entity_rank[:, None] + np.array([0, 2])
+        start_positions = marked_token_offsets[entity_example] + marked_entity_spans[:, 0]
+        end_positions = marked_token_offsets[entity_example] + marked_entity_spans[:, 1]
+
+        marked_tokens = np.empty(marked_token_offsets[-1], dtype=self.tokens.dtype)
+        is_marker = np.zeros(len(marked_tokens), dtype=bool)
+        is_marker[start_positions] = True
+        is_marker[end_positions] = True
+        marked_tokens[start_positions] = np.asarray(start_marker_ids)[self.entity_types]
+        marked_tokens[end_positions] = np.asarray(end_marker_ids)[self.entity_types]
+        marked_tokens[~is_marker] = self.tokens
+
+        return marked_tokens, marked_token_offsets, marked_entity_spans.astype(np.int32)
+
+
+def load_model_data(json_file, entity_type_list, relation_list):
+    source_sha1 = file_sha1(json_file)
+    cache_dir = get_cache_dir(json_file, source_sha1, entity_type_list, relation_list)
+    if read_cache_meta(cache_dir) is None:
+        print(f"Compiling {json_file} ...")
+        compile_model_data(json_file, cache_dir, entity_type_list, relation_list, source_sha1)
+    return CompiledModelData(cache_dir)
@@ -1,8 +1,11 @@
-import torchtext
 import torch
+import numpy as np
 import json
 import os
-from itertools import combinations
+import random
+from itertools import combinations, islice
+from data_cache import load_model_data, file_sha1
+from utils import atomic_open
 
 
 def statistics_corpus(train_file, relation_list):
@@ -88,104 +91,552 @@ def get_corpus_list_information(all_data_flag, corpus_list, base_large):
     return corpus_information, combining_data_files_list, entity_type_list, relation_list
 
 
+def get_source_data_file(base_large, corpus_name, raw_train_valid_test_file, all_data_flag):
+    if all_data_flag:
+        raw_train_valid_test_file = os.path.join('data', corpus_name, 'BIOES', base_large, raw_train_valid_test_file)
+    else:
+        raw_train_valid_test_file = os.path.join('data', corpus_name, 'BIOES', base_large, 'test',
+                                                 raw_train_valid_test_file)
+
+    if base_large == "large":
+        raw_train_valid_test_file = raw_train_valid_test_file.replace("base", "large")
+    return raw_train_valid_test_file
+
+
+def read_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return None
+    try:
+        with open(manifest_file, "r") as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
 def make_model_data(base_large, pick_corpus_file_dic, combining_data_files_list, entity_type_list, relation_list,
                     all_data_flag):
-    # if all file exist, don't generate new
-    temp_flag = 1
-    for file in combining_data_files_list:
-        if os.path.exists(file):
-            temp_flag = temp_flag * 1
-        else:
-            temp_flag = temp_flag * 0
-
-    if temp_flag == 0:
-        for file in combining_data_files_list:
-            if os.path.exists(file):
-                os.remove(file)
-
-        train_data = []
-        valid_data = []
-        test_data = []
-        data_list = [train_data, valid_data, test_data]
-        for corpus_name, corpus_inform in pick_corpus_file_dic.items():
-            corpus_train_valid_test_file = corpus_inform["file_list"]
-            for index, raw_train_valid_test_file in enumerate(corpus_train_valid_test_file):
-                if all_data_flag:
-                    raw_train_valid_test_file = os.path.join('data', corpus_name, 'BIOES', base_large,
-                                                             raw_train_valid_test_file)
-                else:
-                    raw_train_valid_test_file = os.path.join('data', corpus_name, 'BIOES', base_large, 'test',
-                                                             raw_train_valid_test_file)
-
-                if base_large == "large":
-                    raw_train_valid_test_file = raw_train_valid_test_file.replace("base", "large")
-                f = open(raw_train_valid_test_file, 'r', encoding='utf-8')
-                one_task_data = f.readlines()
-                f.close()
-                data_list[index].extend(one_task_data)
-
-        for index, combining_data_files in enumerate(combining_data_files_list):
-            with open(combining_data_files, 'w', encoding='utf-8') as multi_task_file:
-                # random.shuffle(data_list[index])
-                writen_data = data_list[index]
-
-                for one_record in writen_data:
-                    one_record = eval(one_record)
-                    for entity_type in entity_type_list:
-                        if entity_type not in one_record.keys():
-                            one_record[entity_type] = []
-                    for relation in relation_list:
-                        if relation not in one_record.keys():
-                            one_record[relation] = []
-
-                    multi_task_file.write(json.dumps(dict(sorted(one_record.items(), key=lambda item: len(item[0])))))
-                    multi_task_file.write('\n')
-
-
-def prepared_data(tokenizer, file_train_valid_test_list, entity_type_list, relation_list):
-    ID_fields = torchtext.legacy.data.Field(batch_first=True, use_vocab=False, sequential=False)
-    TOKENS_fields = torchtext.legacy.data.Field(batch_first=True, use_vocab=False, pad_token=tokenizer.pad_token_id,
-                                                unk_token=tokenizer.unk_token_id)
-
-    TAGS_sep_entity_fields = torchtext.legacy.data.Field(dtype=torch.long, batch_first=True, unk_token=None,
-                                                         pad_token=tokenizer.pad_token)
-    TAGS_sep_entity_fields_dic = {"sep_entity": ("sep_entity", TAGS_sep_entity_fields)}
-
-    TAGS_Entity_Type_fields_dic = {}
-    for entity in entity_type_list:
-        TAGS_Entity_Type_fields_dic[entity] = (entity, torchtext.legacy.data.Field(dtype=torch.long,
-                                                                                   batch_first=True,
-                                                                                   pad_token=tokenizer.pad_token,
-                                                                                   unk_token=None))
-
-    TAGS_Relation_fields_dic = {}
-    for relation in relation_list:
-        TAGS_Relation_fields_dic[relation] = (relation, torchtext.legacy.data.Field(dtype=torch.long,
-                                                                                    batch_first=True,
-                                                                                    pad_token=tokenizer.pad_token,
-                                                                                    unk_token=None))
-
-    fields = {
-        'ID': ('ID', ID_fields),
-        'tokens': ('tokens', TOKENS_fields),
-        'sep_entity': ('sep_entity', TAGS_sep_entity_fields)
-    }
-    fields.update(TAGS_Entity_Type_fields_dic)
-    fields.update(TAGS_Relation_fields_dic)
-
-    train_file = file_train_valid_test_list[0]
-    valid_file = file_train_valid_test_list[1]
-    test_file = file_train_valid_test_list[2]
-    train_set, valid_set, test_set = torchtext.legacy.data.TabularDataset.splits(path="", train=train_file,
-                                                                                 validation=valid_file,
-                                                                                 test=test_file, format="json",
-                                                                                 fields=fields)
-
-    TAGS_sep_entity_fields.build_vocab(train_set, valid_set, test_set)
-    for entity, field in TAGS_Entity_Type_fields_dic.items():
-        field[1].build_vocab(train_set, valid_set, test_set)
-    for relation, field in TAGS_Relation_fields_dic.items():
-        field[1].build_vocab(train_set, valid_set, test_set)
-
-    return train_set, valid_set, test_set, \
-        TAGS_Entity_Type_fields_dic, TAGS_Relation_fields_dic, TAGS_sep_entity_fields_dic
+    # every combined file has a manifest recording the hash of each source file (in corpus order) and
+    # the entity/relation lists used to pad the records, only the splits whose inputs changed are rebuilt
+    for index, combining_data_file in enumerate(combining_data_files_list):
+        source_file_list = [get_source_data_file(base_large, corpus_name, corpus_inform["file_list"][index],
+                                                 all_data_flag)
+                            for corpus_name, corpus_inform in pick_corpus_file_dic.items()]
+        cache_key = {"source_file_list": [[file, file_sha1(file)] for file in source_file_list],
+                     "entity_type_list": list(entity_type_list),
+                     "relation_list": list(relation_list)}
+
+        manifest_file = os.path.splitext(combining_data_file)[0] + "_manifest.json"
+        manifest = read_manifest(manifest_file)
+        if manifest is not None and manifest["cache_key"] == cache_key and os.path.exists(combining_data_file) \
+                and os.path.getsize(combining_data_file) == manifest["size"]:
+            continue
+
+        print(f"Building {combining_data_file} ...")
+        with atomic_open(combining_data_file) as multi_task_file:
+            for source_file in source_file_list:
+                with open(source_file, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        one_record = json.loads(line)
+                        for entity_type in entity_type_list:
+                            if entity_type not in one_record.keys():
+                                one_record[entity_type] = []
+                        for relation in relation_list:
+                            if relation not in one_record.keys():
+                                one_record[relation] = []
+
+                        multi_task_file.write(
+                            json.dumps(dict(sorted(one_record.items(), key=lambda item: len(item[0])))))
+                        multi_task_file.write('\n')
+
+        with atomic_open(manifest_file) as f:
+            json.dump({"cache_key": cache_key, "size": os.path.getsize(combining_data_file)}, f)
+
+
+def pad_array_list(array_list, pad_value, min_len=0):
+    # integer arrays of shape [n, ...] -> one [batch, max n, ...] tensor padded with pad_value
+    max_len = max([len(x) for x in array_list] + [min_len])
+    padded = np.full((len(array_list), max_len) + np.shape(array_list[0])[1:], pad_value, dtype=np.int64)
+    for index, x in enumerate(array_list):
+        padded[index, :len(x)] = x
+    return torch.from_numpy(padded)
+
+
+class ModelBatch:
+    def __init__(self, **field_dic):
+        self.field_dic = field_dic
+        for name, value in field_dic.items():
+            setattr(self, name, value)
+
+    def __len__(self):
+        return len(self.ID)
+
+    def apply(self, fn):
+        return ModelBatch(**{name: fn(value) if torch.is_tensor(value) else value
+                             for name, value in self.field_dic.items()})
+
+    def pin_memory(self):
+        return self.apply(lambda tensor: tensor.pin_memory())
+
+    def to(self, device, non_blocking=False):
+        return self.apply(lambda tensor: tensor.to(device, non_blocking=non_blocking))
+
+
+def concat_tensor_list(tensor_list, dim, pad_value):
+    # the tensors are padded with pad_value to the same shape except along dim
+    shape = [max(sizes) for sizes in zip(*(tensor.shape for tensor in tensor_list))]
+    padded_list = []
+    for tensor in tensor_list:
+        shape[dim] = tensor.shape[dim]
+        padded = tensor.new_full(shape, pad_value)
+        padded[tuple(slice(0, size) for size in tensor.shape)] = tensor
+        padded_list.append(padded)
+    return torch.cat(padded_list, dim)
+
+
+class ModelBatchCollator:
+    def __init__(self, pad_token_id, label_pad_value=2):
+        self.pad_token_id = pad_token_id
+        # ignore_index of MyRelationClassifier
+        self.label_pad_value = label_pad_value
+
+    def __call__(self, example_list):
+        # ID: [batch]
+        # index: [batch], position of the example in its dataset
+        # tokens: [batch, max length], padded with [PAD]
+        # entity_spans: [batch, max number of entity, 2] (start, end), sorted by start
+        # marked_tokens: [batch, max marked length], tokens with entity markers, padded with [PAD]
+        # marked_entity_spans: [batch, max number of entity, 2] (start marker, end marker) in marked_tokens
+        # relation_labels: [number_of_relation, batch, max(number of entity_pair, 1)], 1 when the pair has the
+        # relation, 3 when the signature of the relation does not match the entity types of the pair, candidate pairs
+        # in itertools.combinations order, padded with label_pad_value
+        # gold_relation_nums: [batch, number_of_relation], number of gold pairs, the filtered ones included
+        # the python lists below stay on the host, the model never has to read them back from the device
+        # entity_pair_list: (entity index, entity index) of the candidate pairs
+        # entity_list, gold_relation_list: decoded spans and relation -> gold pair spans of each example, cached by
+        # the dataset, used by the memory selection
+        return ModelBatch(ID=torch.tensor([example["ID"] for example in example_list], dtype=torch.long),
+                          index=torch.tensor([example["index"] for example in example_list], dtype=torch.long),
+                          tokens=pad_array_list([example["tokens"] for example in example_list], self.pad_token_id),
+                          entity_spans=pad_array_list([example["entity_spans"] for example in example_list], -1),
+                          marked_tokens=pad_array_list([example["marked_tokens"] for example in example_list],
+                                                       self.pad_token_id),
+                          marked_entity_spans=pad_array_list(
+                              [example["marked_entity_spans"] for example in example_list], -1),
+                          relation_labels=pad_array_list([example["relation_labels"] for example in example_list],
+                                                         self.label_pad_value, min_len=1).permute(2, 0, 1),
+                          gold_relation_nums=torch.from_numpy(
+                              np.stack([example["gold_relation_nums"] for example in example_list])),
+                          entity_pair_list=[example["entity_pairs"].tolist() for example in example_list],
+                          entity_list=[example["entity_list"] for example in example_list],
+                          gold_relation_list=[example["gold_relation_dic"] for example in example_list])
+
+    def concat(self, batch_list):
+        # one batch with the examples of every batch of batch_list, one batch after the other, on their device
+        pad_value_dic = {"tokens": self.pad_token_id, "marked_tokens": self.pad_token_id,
+                         "relation_labels": self.label_pad_value}
+        field_dic = {}
+        for name, value in batch_list[0].field_dic.items():
+            value_list = [batch.field_dic[name] for batch in batch_list]
+            if not torch.is_tensor(value):
+                field_dic[name] = [example_value for batch_value in value_list for example_value in batch_value]
+            else:
+                # relation_labels: [number_of_relation, batch, ...]
+                field_dic[name] = concat_tensor_list(value_list, 1 if name == "relation_labels" else 0,
+                                                     pad_value_dic.get(name, -1))
+        return ModelBatch(**field_dic)
+
+
+class ModelDataset(torch.utils.data.Dataset):
+    def __init__(self, compiled_data, collator, start_marker_ids, end_marker_ids, allowed_type_pair_matrix=None,
+                 max_pair_distance=0, not_allowed_label=3):
+        self.compiled_data = compiled_data
+        self.collator = collator
+        self.ID = compiled_data.ID
+        # the entity markers only depend on the example, they are added once here instead of in every forward
+        self.marked_tokens, self.marked_token_offsets, self.marked_entity_spans = \
+            compiled_data.build_marked_tokens(start_marker_ids, end_marker_ids)
+        self.token_nums = np.diff(compiled_data.token_offsets)
+        self.entity_nums = np.diff(compiled_data.entity_offsets)
+
+        # only the candidate pairs go through the classifier, the others are predicted as "no"
+        all_pair_offsets, all_entity_pairs = self.build_all_entity_pairs()
+        all_relation_labels = self.build_relation_labels(all_pair_offsets)
+        candidate_mask, relation_allowed_mask = self.get_candidate_mask(all_pair_offsets, all_entity_pairs,
+                                                                        allowed_type_pair_matrix, max_pair_distance)
+        self.entity_pairs = all_entity_pairs[candidate_mask]
+        self.relation_labels = all_relation_labels[candidate_mask]
+        if relation_allowed_mask is not None:
+            # a relation whose signature does not match the entity types of a candidate pair is predicted as "no"
+            # and left out of the loss (not_allowed_index of MyRelationClassifier), its gold pairs stay in
+            # gold_relation_nums
+            self.relation_labels[~relation_allowed_mask[candidate_mask]] = not_allowed_label
+        candidate_example = np.repeat(np.arange(len(self)), np.diff(all_pair_offsets))[candidate_mask]
+        self.entity_pair_nums = np.bincount(candidate_example, minlength=len(self))
+        self.entity_pair_offsets = np.concatenate([[0], np.cumsum(self.entity_pair_nums)])
+
+        # number of gold pairs of each relation of each example, the pairs dropped from the candidates are counted
+        relation_example = np.repeat(np.arange(len(self)), np.diff(compiled_data.relation_offsets))
+        self.gold_relation_nums = np.zeros((len(self), len(compiled_data.relation_list)), dtype=np.int64)
+        np.add.at(self.gold_relation_nums, (relation_example, compiled_data.relation_pairs[:, 0]), 1)
+        self.decoded_example_cache = {}
+
+        self.all_entity_pair_num = len(all_entity_pairs)
+        gold_pair_num = int(all_relation_labels.any(1).sum())
+        self.gold_pair_keep_ratio = (self.relation_labels == 1).any(1).sum() / gold_pair_num if gold_pair_num else 1.
+
+    def __len__(self):
+        return len(self.compiled_data)
+
+    def build_all_entity_pairs(self):
+        # (entity index, entity index) of every entity pair, in itertools.combinations order of the sorted entities
+        all_pair_nums = self.entity_nums * (self.entity_nums - 1) // 2
+        all_pair_offsets = np.concatenate([[0], np.cumsum(all_pair_nums)])
+        all_entity_pairs = np.zeros((all_pair_offsets[-1], 2), dtype=np.int32)
+        for entity_num in np.unique(self.entity_nums[self.entity_nums >= 2]):
+            # every example with the same number of entities has the same pairs
+            one_entity_num_pairs = np.stack(np.triu_indices(entity_num, k=1), axis=1)
+            example_index = np.flatnonzero(self.entity_nums == entity_num)
+            positions = all_pair_offsets[example_index][:, None] + np.arange(len(one_entity_num_pairs))
+            all_entity_pairs[positions] = one_entity_num_pairs
+        return all_pair_offsets, all_entity_pairs
+
+    def build_relation_labels(self, all_pair_offsets):
+        # gold labels of every entity pair once for the whole dataset: [number of pair, number_of_relation]
+        relation_labels = np.zeros((all_pair_offsets[-1], len(self.compiled_data.relation_list)), dtype=np.int8)
+
+        relation_index, entity_index_1, entity_index_2 = self.compiled_data.relation_pairs.T.astype(np.int64)
+        relation_example = np.repeat(np.arange(len(self)), np.diff(self.compiled_data.relation_offsets))
+        entity_num = self.entity_nums[relation_example]
+        pair_index = entity_index_1 * (2 * entity_num - entity_index_1 - 1) // 2 + entity_index_2 - entity_index_1 - 1
+        relation_labels[all_pair_offsets[relation_example] + pair_index, relation_index] = 1
+        return relation_labels
+
+    def get_candidate_mask(self, all_pair_offsets, all_entity_pairs, allowed_type_pair_matrix, max_pair_distance):
+        # allowed_type_pair_matrix: [number of entity type + 1, number of entity type + 1, number_of_relation], True
+        # when the relation can hold between the two entity types, the last row and column are for entities without
+        # type. A pair is kept when some relation can hold between its entities
+        # max_pair_distance: maximum number of tokens between the two entities, 0 for no limit
+        # returns the candidate mask and the [number of pair, number_of_relation] allowed relations of every pair
+        # (None without allowed_type_pair_matrix)
+        candidate_mask = np.ones(len(all_entity_pairs), dtype=bool)
+        pair_example = np.repeat(np.arange(len(self)), np.diff(all_pair_offsets))
+        entity_index_1 = self.compiled_data.entity_offsets[pair_example] + all_entity_pairs[:, 0]
+        entity_index_2 = self.compiled_data.entity_offsets[pair_example] + all_entity_pairs[:, 1]
+
+        relation_allowed_mask = None
+        if allowed_type_pair_matrix is not None:
+            entity_types = self.compiled_data.entity_types
+            relation_allowed_mask = allowed_type_pair_matrix[entity_types[entity_index_1], entity_types[entity_index_2]]
+            candidate_mask &= relation_allowed_mask.any(1)
+        if max_pair_distance > 0:
+            entity_spans = self.compiled_data.entity_spans
+            candidate_mask &= entity_spans[entity_index_2, 0] - entity_spans[entity_index_1, 1] <= max_pair_distance
+        return candidate_mask, relation_allowed_mask
+
+    def get_sequence_lengths(self, entity_marker):
+        # length of the token sequence given to bert, each entity adds a start and an end marker
+        if entity_marker:
+            return self.token_nums + 2 * self.entity_nums
+        return self.token_nums
+
+    def get_decoded_example(self, index):
+        # span lists of the example, decoded the first time it is used and kept, they never change between epochs
+        decoded_example = self.decoded_example_cache.get(index)
+        if decoded_example is None:
+            entity_list = [list(range(start, end + 1))
+                           for start, end in self.compiled_data.get_entity_spans(index).tolist()]
+            gold_relation_dic = {relation: [] for relation in self.compiled_data.relation_list}
+            for relation_index, i, j in self.compiled_data.get_relation_pairs(index).tolist():
+                gold_relation_dic[self.compiled_data.relation_list[relation_index]].append(
+                    [entity_list[i], entity_list[j]])
+            decoded_example = (entity_list, gold_relation_dic)
+            self.decoded_example_cache[index] = decoded_example
+        return decoded_example
+
+    def __getitem__(self, index):
+        # views of the memory-mapped arrays, nothing is copied before collating
+        entity_list, gold_relation_dic = self.get_decoded_example(index)
+        return {"ID": int(self.ID[index]),
+                "index": index,
+                "tokens": self.compiled_data.get_tokens(index),
+                "entity_spans": self.compiled_data.get_entity_spans(index),
+                "marked_tokens": self.marked_tokens[self.marked_token_offsets[index]:
+                                                    self.marked_token_offsets[index + 1]],
+                "marked_entity_spans": self.marked_entity_spans[self.compiled_data.entity_offsets[index]:
+                                                                self.compiled_data.entity_offsets[index + 1]],
+                "entity_pairs": self.entity_pairs[self.entity_pair_offsets[index]:self.entity_pair_offsets[index + 1]],
+                "relation_labels": self.relation_labels[self.entity_pair_offsets[index]:
+                                                        self.entity_pair_offsets[index + 1]],
+                "gold_relation_nums": self.gold_relation_nums[index],
+                "entity_list": entity_list,
+                "gold_relation_dic": gold_relation_dic}
+
+
+def split_into_batches(indices, sequence_lengths, entity_pair_nums, batch_size, max_tokens=0, max_pairs=0):
+    # fixed batch_size when there is no budget, otherwise each batch is filled in order until the padded number of
+    # tokens ([batch, max length]) or entity pairs ([batch, max number of pairs]) would go beyond its budget
+    if not max_tokens and not max_pairs:
+        return [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+
+    batches = []
+    start = 0
+    max_length = 0
+    max_pair_num = 0
+    for position, (length, pair_num) in enumerate(zip(sequence_lengths[indices].tolist(),
+                                                      entity_pair_nums[indices].tolist())):
+        # a sentence without entity pair still gets one (dummy) pair
+        new_max_length = max(max_length, length)
+        new_max_pair_num = max(max_pair_num, pair_num, 1)
+        new_size = position - start + 1
+        if new_size > 1 and ((max_tokens and new_max_length * new_size > max_tokens) or
+                             (max_pairs and new_max_pair_num * new_size > max_pairs)):
+            batches.append(indices[start:position])
+            start = position
+            new_max_length = length
+            new_max_pair_num = max(pair_num, 1)
+        max_length = new_max_length
+        max_pair_num = new_max_pair_num
+    if start < len(indices):
+        batches.append(indices[start:])
+    return batches
+
+
+class BucketBatchSampler:
+    # examples are sorted by (number of entity pairs, sequence length) inside pools of pool_size_multiplier batches,
+    # so a batch holds examples needing little padding, while the order of the batches stays random.
+    # with max_tokens / max_pairs, batches hold a variable number of examples bounded by these budgets
+    def __init__(self, sequence_lengths, entity_pair_nums, batch_size, shuffle=True, bucket=True,
+                 pool_size_multiplier=100, max_tokens=0, max_pairs=0):
+        self.sequence_lengths = np.asarray(sequence_lengths)
+        self.entity_pair_nums = np.asarray(entity_pair_nums)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket = bucket
+        self.max_tokens = max_tokens
+        self.max_pairs = max_pairs
+        self.pool_size = batch_size * pool_size_multiplier
+        self.batches = None
+        # real tokens, tokens after padding, real entity pairs, entity pairs after padding
+        self.padding_statistics = [0, 0, 0, 0]
+
+    def __len__(self):
+        # the number of budget batches depends on the order of the examples, so the next epoch is drawn here
+        if self.batches is None:
+            self.batches = self.get_batches()
+        return len(self.batches)
+
+    def split_into_batches(self, indices):
+        return split_into_batches(indices, self.sequence_lengths, self.entity_pair_nums, self.batch_size,
+                                  self.max_tokens, self.max_pairs)
+
+    def get_batches(self):
+        indices = np.random.permutation(len(self.sequence_lengths)) if self.shuffle \
+            else np.arange(len(self.sequence_lengths))
+        if not self.bucket:
+            return self.split_into_batches(indices)
+
+        batches = []
+        for pool_start in range(0, len(indices), self.pool_size):
+            pool_indices = indices[pool_start:pool_start + self.pool_size]
+            pool_indices = pool_indices[np.lexsort((self.sequence_lengths[pool_indices],
+                                                    self.entity_pair_nums[pool_indices]))]
+            batches += self.split_into_batches(pool_indices)
+        if self.shuffle:
+            random.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        batches = self.batches if self.batches is not None else self.get_batches()
+        self.batches = None
+        self.padding_statistics = [0, 0, 0, 0]
+        for batch in batches:
+            self.padding_statistics[0] += int(self.sequence_lengths[batch].sum())
+            self.padding_statistics[1] += int(self.sequence_lengths[batch].max()) * len(batch)
+            self.padding_statistics[2] += int(self.entity_pair_nums[batch].sum())
+            # a sentence without entity pair still gets one (dummy) pair
+            self.padding_statistics[3] += max(int(self.entity_pair_nums[batch].max()), 1) * len(batch)
+            yield batch.tolist()
+
+    def padding_ratio(self):
+        real_token_num, padded_token_num, real_pair_num, padded_pair_num = self.padding_statistics
+        token_padding_ratio = 1 - real_token_num / padded_token_num if padded_token_num else 0
+        pair_padding_ratio = 1 - real_pair_num / padded_pair_num if padded_pair_num else 0
+        return token_padding_ratio, pair_padding_ratio
+
+
+class BatchIterator:
+    # batches are collated by num_workers processes (prefetching prefetch_factor batches each) into pinned memory,
+    # then copied to the device without blocking, so building batches overlaps with the forward/backward pass
+    def __init__(self, dataset, collate_fn, batch_sampler, device, num_workers=0, prefetch_factor=2):
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.device = device
+        worker_kwargs = {"prefetch_factor": prefetch_factor, "persistent_workers": True} if num_workers > 0 else {}
+        self.data_loader = torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler,
+                                                       collate_fn=collate_fn, num_workers=num_workers,
+                                                       pin_memory=device.type == "cuda", **worker_kwargs)
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        for batch in self.data_loader:
+            yield batch.to(self.device, non_blocking=True)
+
+
+class ReplayBuffer:
+    # memorized examples of every corpus, kept as already read (copied out of the memory-mapped arrays) examples
+    # looked up by dataset index and drawn lazily, so a replay batch costs O(batch) instead of a scan of the training
+    # data or of the memory.
+    # balanced: the corpora take turns in a replay batch instead of being drawn in proportion to their memory.
+    # prebuilt_batch_num: that many replay batches are collated on the device every time a corpus is added and
+    # drawn at random afterwards, 0 to collate a fresh batch at every step
+    def __init__(self, dataset, sequence_lengths, batch_size, device, max_tokens=0, max_pairs=0, balanced=False,
+                 prebuilt_batch_num=0):
+        self.dataset = dataset
+        self.sequence_lengths = sequence_lengths
+        self.batch_size = batch_size
+        self.device = device
+        self.max_tokens = max_tokens
+        self.max_pairs = max_pairs
+        self.balanced = balanced
+        self.prebuilt_batch_num = prebuilt_batch_num
+        self.ID_to_index_dic = {ID: index for index, ID in enumerate(dataset.ID.tolist())}
+        self.corpus_to_indices_dic = {}
+        self.index_list = []
+        self.example_dic = {}
+        # corpus name (None for every corpus) -> (shuffled memorized indices, position of the next one to draw)
+        self.order_dic = {}
+        self.prebuilt_batch_list = []
+
+    def __len__(self):
+        return len(self.index_list)
+
+    def add_corpus(self, corpus_name, ID_list):
+        indices = [self.ID_to_index_dic[ID] for ID in ID_list]
+        self.corpus_to_indices_dic[corpus_name] = indices
+        self.index_list += indices
+        self.order_dic = {}
+        for index in indices:
+            self.example_dic[index] = {name: np.array(value) if isinstance(value, np.ndarray) else value
+                                       for name, value in self.dataset[index].items()}
+        if self.prebuilt_batch_num:
+            self.prebuilt_batch_list = [self.collate(self.sample_indices()) for _ in range(self.prebuilt_batch_num)]
+
+    def next_index(self, drawn_set, corpus_name=None):
+        # the memorized examples of the corpus (all of them for None) are drawn from a shuffled order, reshuffled once
+        # every example has been drawn, so drawing an example is O(1). drawn_set: the examples of the batch being
+        # drawn, they go to the end of a new order so a batch never holds an example twice
+        order, cursor = self.order_dic.get(corpus_name, ([], 0))
+        if cursor == len(order):
+            order = list(self.index_list if corpus_name is None else self.corpus_to_indices_dic[corpus_name])
+            random.shuffle(order)
+            order = [index for index in order if index not in drawn_set] + \
+                    [index for index in order if index in drawn_set]
+            cursor = 0
+        self.order_dic[corpus_name] = (order, cursor + 1)
+        drawn_set.add(order[cursor])
+        return order[cursor]
+
+    def iter_indices(self):
+        # random memorized examples, drawn lazily and each at most once
+        drawn_set = set()
+        if not self.balanced:
+            for _ in range(len(self.index_list)):
+                yield self.next_index(drawn_set)
+            return
+        corpus_name_list = list(self.corpus_to_indices_dic.keys())
+        random.shuffle(corpus_name_list)
+        # a corpus with too few memorized examples leaves its turns to the others
+        for turn in range(max((len(indices) for indices in self.corpus_to_indices_dic.values()), default=0)):
+            for corpus_name in corpus_name_list:
+                if turn < len(self.corpus_to_indices_dic[corpus_name]):
+                    yield self.next_index(drawn_set, corpus_name)
+
+    def sample_indices(self):
+        # batch_size examples when there is no budget, otherwise examples until the next one would not fit in it
+        if not self.max_tokens and not self.max_pairs:
+            return list(islice(self.iter_indices(), self.batch_size))
+
+        indices = []
+        max_length = 0
+        max_pair_num = 0
+        for index in self.iter_indices():
+            # a sentence without entity pair still gets one (dummy) pair, like in split_into_batches
+            max_length = max(max_length, int(self.sequence_lengths[index]))
+            max_pair_num = max(max_pair_num, int(self.dataset.entity_pair_nums[index]), 1)
+            size = len(indices) + 1
+            if indices and ((self.max_tokens and max_length * size > self.max_tokens) or
+                            (self.max_pairs and max_pair_num * size > self.max_pairs)):
+                break
+            indices.append(index)
+        return indices
+
+    def collate(self, indices):
+        return self.dataset.collator([self.example_dic[index] for index in indices]).to(self.device)
+
+    def get_batch(self):
+        if self.prebuilt_batch_list:
+            return random.choice(self.prebuilt_batch_list)
+        return self.collate(self.sample_indices())
+
+
+def get_relation_signature_dic(corpus_information):
+    # relation -> the (entity type, entity type) pairs it can hold between, from every corpus
+    relation_signature_dic = {}
+    for value in corpus_information.values():
+        for relation, signature_list in value.get("relation_signature", {}).items():
+            for signature in signature_list:
+                if signature not in relation_signature_dic.setdefault(relation, []):
+                    relation_signature_dic[relation].append(signature)
+    return relation_signature_dic
+
+
+def get_allowed_type_pair_matrix(entity_type_list, relation_list, relation_signature_dic):
+    # [entity type, entity type, relation], the last row and column are for entities without type, they are always
+    # kept for every relation
+    entity_type_index_dic = {entity_type: index for index, entity_type in enumerate(entity_type_list)}
+    allowed_type_pair_matrix = np.zeros((len(entity_type_list) + 1, len(entity_type_list) + 1, len(relation_list)),
+                                        dtype=bool)
+    allowed_type_pair_matrix[-1, :] = True
+    allowed_type_pair_matrix[:, -1] = True
+    for relation_index, relation in enumerate(relation_list):
+        if relation not in relation_signature_dic:
+            raise Exception(f"No relation_signature of {relation} in corpus_information.json !")
+        for entity_type_1, entity_type_2 in relation_signature_dic[relation]:
+            index_1, index_2 = entity_type_index_dic[entity_type_1], entity_type_index_dic[entity_type_2]
+            allowed_type_pair_matrix[index_1, index_2, relation_index] = True
+            allowed_type_pair_matrix[index_2, index_1, relation_index] = True
+    return allowed_type_pair_matrix
+
+
+def prepared_data(tokenizer, file_train_valid_test_list, entity_type_list, relation_list, relation_signature_dic=None,
+                  max_pair_distance=0):
+    collator = ModelBatchCollator(tokenizer.pad_token_id)
+
+    # entities without type are marked by [Entity_None], which is not a special token
+    start_marker_ids = tokenizer.convert_tokens_to_ids(["[Entity_" + entity_type + "]"
+                                                        for entity_type in entity_type_list + ["None"]])
+    end_marker_ids = tokenizer.convert_tokens_to_ids(["[/Entity_" + entity_type + "]"
+                                                      for entity_type in entity_type_list + ["None"]])
+
+    # candidate pairs: the entity types must match the signature of a relation, and the entities must be close enough.
+    # The relations whose signature does not match are predicted as "no" for the pair
+    allowed_type_pair_matrix = None
+    if relation_signature_dic is not None:
+        allowed_type_pair_matrix = get_allowed_type_pair_matrix(entity_type_list, relation_list, relation_signature_dic)
+
+    # the json files are compiled once into memory-mapped arrays, later runs only open them
+    dataset_list = []
+    for file in file_train_valid_test_list:
+        dataset = ModelDataset(load_model_data(file, entity_type_list, relation_list), collator, start_marker_ids,
+                               end_marker_ids, allowed_type_pair_matrix, max_pair_distance)
+        if allowed_type_pair_matrix is not None or max_pair_distance > 0:
+            print(f"{os.path.basename(file)}: candidate pairs {len(dataset.entity_pairs)}/"
+                  f"{dataset.all_entity_pair_num}, gold pairs kept {dataset.gold_pair_keep_ratio:.3f}")
+        dataset_list.append(dataset)
+    train_set, valid_set, test_set = dataset_list
+
+    return train_set, valid_set, test_set
@@ -1,3 +1,6 @@
+import torch
+
+
 def calc_micro_P_R_F1(relation_TP_FN_FP):
     total_TP = 0
     total_FN = 0
@@ -19,27 +22,6 @@ def calc_P_R_F1(TP, FN, FP):
     return P * 100, R * 100, F1 * 100
 
 
-def accumulated_relation_TP_FN_FP(pred, gold, relation, relation_TP_FN_FP):
-    TP = 0
-    for one_gold in gold:
-        if one_gold in pred:
-            TP += 1
-
-    FP = len(pred) - TP
-    FN = len(gold) - TP
-    assert TP >= 0
-    assert FN >= 0
-    assert FP >= 0
-
-    if relation not in relation_TP_FN_FP.keys():
-        relation_TP_FN_FP[relation] = [TP, FN, FP]
-    else:
-        relation_TP_FN_FP[relation][0] += TP
-        relation_TP_FN_FP[relation][1] += FN
-        relation_TP_FN_FP[relation][2] += FP
-    return relation_TP_FN_FP
-
-
 def calc_relation_P_R_F1(relation_TP_FN_FP):
     relation_P_R_F1 = {}
     for relation, (TP, FN, FP) in relation_TP_FN_FP.items():
@@ -64,23 +46,56 @@ def calc_relation_P_R_F1(relation_TP_FN_FP):
 #     return corpus_micro_P_R_F1
 
 
-def report_relation_PRF(list_batch_res, relation_list):
-    relation_TP_FN_FP = {}
-
-    for batch_gold, batch_pred in list_batch_res:
-        for sent_gold, sent_pred in zip(batch_gold, batch_pred):
-            for relation in relation_list:
-                relation_TP_FN_FP = accumulated_relation_TP_FN_FP(sent_pred[relation],
-                                                                  sent_gold[relation],
-                                                                  relation,
-                                                                  relation_TP_FN_FP)
-
-    relation_P_R_F1 = calc_relation_P_R_F1(relation_TP_FN_FP)
-    micro_P, micro_R, micro_F1 = calc_micro_P_R_F1(relation_TP_FN_FP)
-    return micro_P, micro_R, micro_F1, relation_P_R_F1, relation_TP_FN_FP
-
-
-def report_performance(corpus_name, epoch, dic_loss, dic_batches_res, relation_list, valid_flag):
+class StreamingRelationCounter(object):
+    # TP, FN, FP of every corpus and relation and the loss, summed batch after batch on the device and read back once
+    # at the end of the epoch, nothing of the batches is kept
+    # example_corpus_index: [number of example in the dataset], corpus of every example, every example is in corpus 0
+    # when it is None
+    def __init__(self, relation_list, example_corpus_index=None, corpus_num=1):
+        self.relation_list = relation_list
+        self.example_corpus_index = example_corpus_index
+        self.corpus_num = corpus_num
+        self.example_corpus_index_tensor = None
+        self.relation_TP_FN_FP_tensor = None
+        self.loss_sum = None
+        self.batch_num = 0
+
+    def get_batch_corpus_index(self, batch_index, device):
+        if self.example_corpus_index is None:
+            return torch.zeros(len(batch_index), dtype=torch.long, device=device)
+        if self.example_corpus_index_tensor is None:
+            self.example_corpus_index_tensor = torch.as_tensor(self.example_corpus_index, dtype=torch.long,
+                                                               device=device)
+        return self.example_corpus_index_tensor[batch_index.to(device, non_blocking=True)]
+
+    def update(self, batch_sent_relation_TP_FN_FP, batch_loss, batch_index):
+        # batch_sent_relation_TP_FN_FP: [batch, number_of_relation, 3], batch_index: [batch] index of the examples
+        batch_loss = batch_loss.detach().float()
+        device = batch_sent_relation_TP_FN_FP.device
+        if self.relation_TP_FN_FP_tensor is None:
+            self.relation_TP_FN_FP_tensor = batch_sent_relation_TP_FN_FP.new_zeros(
+                (self.corpus_num,) + batch_sent_relation_TP_FN_FP.shape[1:])
+            self.loss_sum = torch.zeros((), device=batch_loss.device)
+        self.relation_TP_FN_FP_tensor.index_add_(0, self.get_batch_corpus_index(batch_index, device),
+                                                 batch_sent_relation_TP_FN_FP)
+        self.loss_sum += batch_loss
+        self.batch_num += 1
+
+    def get_relation_TP_FN_FP(self, corpus_index_list=None):
+        # summed over the corpora in corpus_index_list, all of them when it is None
+        if self.relation_TP_FN_FP_tensor is None:
+            return {relation: [0, 0, 0] for relation in self.relation_list}
+        relation_TP_FN_FP_tensor = self.relation_TP_FN_FP_tensor
+        if corpus_index_list is not None:
+            relation_TP_FN_FP_tensor = relation_TP_FN_FP_tensor[list(corpus_index_list)]
+        return dict(zip(self.relation_list, relation_TP_FN_FP_tensor.sum(0).tolist()))
+
+    def get_dic_loss(self):
+        loss_sum = self.loss_sum.item() if self.loss_sum is not None else 0.
+        return {"relation": loss_sum, "average": loss_sum / max(self.batch_num, 1)}
+
+
+def report_performance(corpus_name, epoch, dic_loss, relation_TP_FN_FP, valid_flag):
     if valid_flag == "train":
         print(corpus_name)
         print('Epoch: %1d, train average_loss: %2f' % (epoch, dic_loss["average"]))
@@ -91,8 +106,8 @@ def report_performance(corpus_name, epoch, dic_loss, dic_batches_res, relation_l
         print(corpus_name)
         print("  testing ... ")
 
-    micro_P, micro_R, micro_F1, relation_P_R_F1, relation_TP_FN_FP = report_relation_PRF(dic_batches_res["relation"],
-                                                                                         relation_list)
+    relation_P_R_F1 = calc_relation_P_R_F1(relation_TP_FN_FP)
+    micro_P, micro_R, micro_F1 = calc_micro_P_R_F1(relation_TP_FN_FP)
     print('          P: %.3f, R: %.3f, F1: %.3f \t\n\t\t\t'
           % (micro_P, micro_R, micro_F1))
 
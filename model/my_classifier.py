@@ -1,17 +1,16 @@
+import math
 import torch.nn as nn
 import torch
-import torchtext
-from torch.nn.utils.rnn import pad_sequence
 import torch.nn.functional as F
 
 
 class MyBinaryClassifier(nn.Module):
-    def __init__(self, TAGS_fields, input_dim, device, ignore_index=None, loss_weight=None):
+    def __init__(self, yes_no_vocab, input_dim, device, ignore_index=None, loss_weight=None):
         super(MyBinaryClassifier, self).__init__()
         self.to(device)
         self.ignore_index = ignore_index
         self.input_dim = input_dim
-        self.output_dim = len(TAGS_fields.vocab)
+        self.output_dim = len(yes_no_vocab)
         self.fc1 = nn.Linear(self.input_dim, int(self.input_dim / 2), bias=False)
         self.fc2 = nn.Linear(int(self.input_dim / 2), self.output_dim, bias=False)
         self.loss_weight = loss_weight
@@ -28,16 +27,38 @@ class MyBinaryClassifier(nn.Module):
         return cross_entropy_loss
 
 
+class MyFusedBinaryClassifier(nn.Module):
+    # the MyBinaryClassifier of every relation in one module, the weights are stacked on a relation dimension
+    # so all relations are evaluated by one einsum per layer
+    def __init__(self, relation_num, yes_no_vocab, input_dim, device):
+        super(MyFusedBinaryClassifier, self).__init__()
+        self.to(device)
+        self.input_dim = input_dim
+        self.output_dim = len(yes_no_vocab)
+        self.fc1_weight = nn.Parameter(torch.empty(relation_num, int(self.input_dim / 2), self.input_dim))
+        self.fc2_weight = nn.Parameter(torch.empty(relation_num, self.output_dim, int(self.input_dim / 2)))
+        # same initialization as nn.Linear, relation by relation
+        for relation_index in range(relation_num):
+            nn.init.kaiming_uniform_(self.fc1_weight[relation_index], a=math.sqrt(5))
+            nn.init.kaiming_uniform_(self.fc2_weight[relation_index], a=math.sqrt(5))
+
+    def forward(self, common_embedding):
+        # [..., input_dim] -> [number_of_relation, ..., output_dim]
+        res = F.relu(torch.einsum("...i,rhi->r...h", common_embedding, self.fc1_weight))
+        res = torch.einsum("r...h,roh->r...o", res, self.fc2_weight)
+        return res
+
+
 class MyRelationClassifier(nn.Module):
     def __init__(self, args, device):
         super(MyRelationClassifier, self).__init__()
         self.to(device)
         self.args = args
         self.device = device
-        self.TAGS_my_types_classification = torchtext.legacy.data.Field(dtype=torch.long, batch_first=True,
-                                                                        pad_token=None, unk_token=None)
-        self.TAGS_my_types_classification.vocab = {"no": 0, "yes": 1}
-        self.ignore_index = len(self.TAGS_my_types_classification.vocab)
+        self.yes_no_vocab = {"no": 0, "yes": 1}
+        self.ignore_index = len(self.yes_no_vocab)
+        # label of a relation that cannot hold between the entity types of the pair, predicted as "no", not in the loss
+        self.not_allowed_index = self.ignore_index + 1
         if self.args.Entity_Prep_Way == "entity_type_marker":
             self.relation_input_dim = self.args.Word_embedding_size
         else:
@@ -51,92 +72,95 @@ class MyRelationClassifier(nn.Module):
     def get_binary_classifier(self, i):
         return getattr(self, 'my_classifier_{0}'.format(i))
 
-    def create_classifiers(self, TAGS_Types_fields_dic,
-                           TAGS_sep_entity_fields_dic,
-                           TAGS_Entity_Type_fields_dic):
-        self.TAGS_Types_fields_dic = TAGS_Types_fields_dic
-        self.TAGS_Entity_Type_fields_dic = TAGS_Entity_Type_fields_dic
-        self.TAGS_sep_entity_fields_dic = TAGS_sep_entity_fields_dic
-        self.relation_list = list(self.TAGS_Types_fields_dic.keys())
-        self.entity_type_list = list(self.TAGS_Entity_Type_fields_dic.keys())
+    def create_classifiers(self, relation_list, entity_type_list):
+        self.relation_list = list(relation_list)
+        self.entity_type_list = list(entity_type_list)
+
+        if self.args.Fused_head:
+            self.fused_classifier = MyFusedBinaryClassifier(len(self.relation_list), self.yes_no_vocab,
+                                                            self.relation_input_dim, self.device)
+            return
 
         for relation in self.relation_list:
-            my_binary_classifier = MyBinaryClassifier(self.TAGS_my_types_classification,
+            my_binary_classifier = MyBinaryClassifier(self.yes_no_vocab,
                                                       self.relation_input_dim, self.device,
                                                       ignore_index=self.ignore_index)
             setattr(self, f'my_classifier_{relation}', my_binary_classifier)
 
-    def forward(self, batch_added_marker_entity_span_vec):
-        loss_list = []
-        sub_task_res_prob_list = []
-        sub_task_res_yes_no_index_list = []
-        for relation in self.relation_list:
-            res = self.get_binary_classifier(relation)(batch_added_marker_entity_span_vec)
-            loss_list.append(res)
-            res = torch.max(res, 2)
-            sub_task_res_prob_list.append(res[0])
-            sub_task_res_yes_no_index_list.append(res[1])
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        # checkpoints of the per relation heads (my_classifier_{relation}.fc1.weight ...) and of the fused head
+        # (fused_classifier.fc1_weight ...) can be loaded by both, the weights are stacked or split here
+        for layer in ["fc1", "fc2"]:
+            fused_key = f"{prefix}fused_classifier.{layer}_weight"
+            relation_key_list = [f"{prefix}my_classifier_{relation}.{layer}.weight" for relation in self.relation_list]
+            if self.args.Fused_head and all(key in state_dict for key in relation_key_list):
+                state_dict[fused_key] = torch.stack([state_dict.pop(key) for key in relation_key_list])
+            elif not self.args.Fused_head and fused_key in state_dict:
+                for key, weight in zip(relation_key_list, state_dict.pop(fused_key).unbind(0)):
+                    state_dict[key] = weight
+        super(MyRelationClassifier, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                                                missing_keys, unexpected_keys, error_msgs)
+
+    def forward(self, batch_added_marker_entity_span_vec, relation_allowed_mask=None):
+        # logits of every relation: [number_of_relation, batch, number of pair, 2],
+        # or [number_of_relation, total number of pair, 2] for packed pairs
+        # relation_allowed_mask: same shape without the last dimension, False to predict "no" for the relation
+        if self.args.Fused_head:
+            batch_pred_logits = self.fused_classifier(batch_added_marker_entity_span_vec)
+        else:
+            batch_pred_logits = torch.stack([self.get_binary_classifier(relation)(batch_added_marker_entity_span_vec)
+                                             for relation in self.relation_list])
 
-        batch_pred_res_prob = torch.stack(sub_task_res_prob_list).permute(1, 2, 0)
-        batch_pred_res_yes_no_index = torch.stack(sub_task_res_yes_no_index_list).permute(1, 2, 0)
+        batch_pred_res_prob, batch_pred_res_yes_no_index = torch.max(batch_pred_logits, -1)
+        batch_pred_res_prob = batch_pred_res_prob.movedim(0, -1)
+        batch_pred_res_yes_no_index = batch_pred_res_yes_no_index.movedim(0, -1)
 
-        yes_flag_tensor = torch.tensor(self.TAGS_my_types_classification.vocab["yes"], device=self.device)
-        no_mask_tensor = batch_pred_res_yes_no_index != yes_flag_tensor
+        no_mask_tensor = batch_pred_res_yes_no_index != self.yes_no_vocab["yes"]
+        if relation_allowed_mask is not None:
+            no_mask_tensor |= ~relation_allowed_mask.movedim(0, -1)
 
-        batch_pred_res_prob_masked = torch.masked_fill(batch_pred_res_prob, no_mask_tensor,
-                                                       torch.tensor(-999, device=self.device))
+        batch_pred_res_prob_masked = torch.masked_fill(batch_pred_res_prob, no_mask_tensor, -999)
 
         # deal the solution of all results are no, there is None classifier, commented down these two lines
-        pad_tensor = torch.Tensor(batch_pred_res_prob_masked.shape[0], batch_pred_res_prob_masked.shape[1], 1).fill_(-998).to(self.device)
-        batch_pred_res_prob_masked = torch.cat((batch_pred_res_prob_masked, pad_tensor), 2)
-
-        pred_type_tensor = torch.max(batch_pred_res_prob_masked, 2)[1]
-
-        return pred_type_tensor, loss_list
-
-    def make_gold_for_loss(self, batch_gold_res_list, batch_entity_pair_list, vocab_dic):
-        batch_gold_for_loss_sub_task_list = []
-        for sent_index, sent_entity_pair_list in enumerate(batch_entity_pair_list):
-            one_sent_list = []
-            for entity_pair in sent_entity_pair_list:
-                relation_for_entity_pair = []
-                for relation, relation_entity_pair_list in batch_gold_res_list[sent_index].items():
-                    if entity_pair in relation_entity_pair_list:
-                        relation_for_entity_pair.append(torch.tensor(vocab_dic["yes"], dtype=torch.long, device=self.device))
-                    else:
-                        relation_for_entity_pair.append(torch.tensor(vocab_dic["no"], dtype=torch.long, device=self.device))
-                one_sent_list.append(torch.stack(relation_for_entity_pair))
-
-            if not one_sent_list:
-                pad_sub_task_list = [torch.tensor(self.ignore_index, dtype=torch.long, device=self.device)] * len(
-                    self.relation_list)
-                one_sent_list.append(torch.stack(pad_sub_task_list))
-
-            batch_gold_for_loss_sub_task_list.append(torch.stack(one_sent_list))
-
-        gold_for_loss_sub_task_tensor = pad_sequence(batch_gold_for_loss_sub_task_list, batch_first=True,
-                                                     padding_value=self.ignore_index)   # [batch, max(number of entity_pair), number_of_relation]
-        gold_for_loss_sub_task_tensor = gold_for_loss_sub_task_tensor.permute(2, 0, 1)  # [number_of_relation, batch, max(number of entity_pair)]
-
-        return gold_for_loss_sub_task_tensor
-
-    def get_ensembled_ce_loss(self, batch_pred_for_loss_sub_task_list, batch_gold_for_loss_sub_task_tensor):
-        loss_list = []
-        for sub_task_index, sub_task_batch_pred in enumerate(batch_pred_for_loss_sub_task_list):
-            sub_task_batch_gold = batch_gold_for_loss_sub_task_tensor[sub_task_index]
-            ce_loss = F.cross_entropy(sub_task_batch_pred.permute(0, 2, 1), sub_task_batch_gold,
-                                      ignore_index=self.ignore_index, weight=self.yes_no_weight, reduction='mean')
-            loss_list.append(ce_loss)
-        return sum(loss_list) / len(loss_list)
-
-    def BCE_loss(self, batch_pred_for_loss_sub_task_list, batch_gold_for_loss_sub_task_tensor):
-        loss_list = []
-        for sub_task_index, sub_task_batch_pred in enumerate(batch_pred_for_loss_sub_task_list):
-            sub_task_batch_gold = batch_gold_for_loss_sub_task_tensor[sub_task_index]
-            target_tensor = torch.where(sub_task_batch_gold == self.ignore_index, torch.tensor(0, device=self.device), sub_task_batch_gold)
-            target_tensor = torch.zeros(sub_task_batch_pred.shape, device=self.device).scatter_(2, target_tensor.unsqueeze(2), 1)
-
-            criterion = nn.BCEWithLogitsLoss(pos_weight=self.yes_no_weight, reduction='mean')
-            bec_loss = criterion(sub_task_batch_pred, target_tensor)
-            loss_list.append(bec_loss)
-        return sum(loss_list) / len(loss_list)
+        pad_tensor = batch_pred_res_prob_masked.new_full(batch_pred_res_prob_masked.shape[:-1] + (1,), -998)
+        batch_pred_res_prob_masked = torch.cat((batch_pred_res_prob_masked, pad_tensor), -1)
+
+        pred_type_tensor = torch.max(batch_pred_res_prob_masked, -1)[1]
+
+        return pred_type_tensor, batch_pred_logits
+
+    def get_ensembled_ce_loss(self, batch_pred_logits, batch_gold_for_loss_sub_task_tensor):
+        # batch_pred_logits: [number_of_relation, batch, number of pair, 2]
+        # batch_gold_for_loss_sub_task_tensor: [number_of_relation, batch, number of pair]
+        # weighted mean over the pairs of each relation (ignore_index and not_allowed_index excluded), then mean over
+        # the relations with at least one pair
+        relation_num = batch_pred_logits.shape[0]
+        batch_gold_for_loss_sub_task_tensor = batch_gold_for_loss_sub_task_tensor.masked_fill(
+            batch_gold_for_loss_sub_task_tensor == self.not_allowed_index, self.ignore_index)
+        ce_loss = F.cross_entropy(batch_pred_logits.reshape(-1, batch_pred_logits.shape[-1]),
+                                  batch_gold_for_loss_sub_task_tensor.reshape(-1), ignore_index=self.ignore_index,
+                                  weight=self.yes_no_weight, reduction='none').view(relation_num, -1)
+
+        valid_mask = batch_gold_for_loss_sub_task_tensor != self.ignore_index
+        if self.yes_no_weight is None:
+            pair_weight = valid_mask.to(ce_loss.dtype)
+        else:
+            pair_weight = self.yes_no_weight[batch_gold_for_loss_sub_task_tensor.masked_fill(~valid_mask, 0)]
+            pair_weight = pair_weight * valid_mask
+        relation_weight = pair_weight.view(relation_num, -1).sum(1)
+        relation_mask = relation_weight > 0
+        relation_loss = ce_loss.sum(1) / relation_weight.masked_fill(~relation_mask, 1)
+        return (relation_loss * relation_mask).sum() / relation_mask.sum().clamp(min=1)
+
+    def BCE_loss(self, batch_pred_logits, batch_gold_for_loss_sub_task_tensor):
+        # the pairs with ignore_index are counted as "no", the ones with not_allowed_index are left out. Without
+        # them, every relation has the same number of pairs so the mean over everything is the mean over the
+        # relations of the mean of each relation
+        allowed_mask = (batch_gold_for_loss_sub_task_tensor != self.not_allowed_index).unsqueeze(-1)
+        target_tensor = batch_gold_for_loss_sub_task_tensor.masked_fill(
+            batch_gold_for_loss_sub_task_tensor >= self.ignore_index, 0)
+        target_tensor = F.one_hot(target_tensor, batch_pred_logits.shape[-1]).float()
+        bce_loss = F.binary_cross_entropy_with_logits(batch_pred_logits, target_tensor, pos_weight=self.yes_no_weight,
+                                                      weight=allowed_mask.to(batch_pred_logits.dtype), reduction='sum')
+        return bce_loss / (allowed_mask.sum() * batch_pred_logits.shape[-1]).clamp(min=1)
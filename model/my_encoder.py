@@ -1,9 +1,8 @@
 import torch.nn as nn
 import torch
+import numpy as np
 from itertools import combinations
-from torch.nn.utils.rnn import pad_sequence
 import torch.nn.functional as F
-import copy
 
 
 class MyEncoder(nn.Module):
@@ -17,6 +16,8 @@ class MyEncoder(nn.Module):
         self.linear_transform = nn.Linear(self.args.Word_embedding_size * 2, self.args.Word_embedding_size)
         self.layer_normalization = nn.LayerNorm([self.args.Word_embedding_size])
         self.output_dim = args.Word_embedding_size
+        # sentences without candidate pair, not given to bert, reset by the caller
+        self.skipped_sequence_num = 0
 
     def forward(self, batch_inputs, ignore_index=0, encoder_hidden_states=None):
         tokens_tensor = self.get_bert_input(batch_inputs)
@@ -29,186 +30,146 @@ class MyEncoder(nn.Module):
 
         return last_common_embedding
 
+    def forward_sentences_with_pair(self, batch_inputs, batch_sent_len_list, ignore_index=0):
+        # only the sentences having at least one entity pair are given to bert, the others get zero embeddings,
+        # their pair representations are padding anyway
+        keep_index_list = [sent_index for sent_index, sent_len in enumerate(batch_sent_len_list) if sent_len > 0]
+        self.skipped_sequence_num += len(batch_sent_len_list) - len(keep_index_list)
+        if len(keep_index_list) == len(batch_sent_len_list):
+            return self.forward(batch_inputs, ignore_index=ignore_index)
+
+        common_embedding = batch_inputs.new_zeros(batch_inputs.shape + (self.output_dim,), dtype=torch.float)
+        if keep_index_list:
+            keep_index = torch.tensor(keep_index_list, device=self.device)
+            keep_embedding = self.forward(batch_inputs.index_select(0, keep_index), ignore_index=ignore_index)
+            common_embedding = common_embedding.to(keep_embedding.dtype).index_copy(0, keep_index, keep_embedding)
+        return common_embedding
+
     def get_bert_input(self, batch_inputs):
-        input_tensor = torch.tensor(batch_inputs, device=self.device)
-        return input_tensor
+        # the batch is already a tensor on the device, no copy
+        return batch_inputs.to(self.device, non_blocking=True)
 
     def get_attention_mask(self, tokens_tensor, ignore_index):
-        attention_mask = torch.where(tokens_tensor == ignore_index, torch.tensor(0., device=self.device),
-                                     torch.tensor(1., device=self.device))
-        return attention_mask
+        return (tokens_tensor != ignore_index).float()
 
     def get_position_ids(self, tokens_tensor):
         position_ids = torch.arange(tokens_tensor.shape[1], device=self.device).expand((1, -1))
         return position_ids
 
-    def get_entity_pair_rep(self, entity_pair_span, sentence_embedding):
-        entity_span_1, entity_span_2 = entity_pair_span
-        entity_1_head = entity_span_1[0]
-        entity_1_tail = entity_span_1[-1]
-        entity_2_head = entity_span_2[0]
-        entity_2_tail = entity_span_2[-1]
-
+    def get_entity_pair_index(self, batch_entity_pair_list):
+        # (entity index, entity index) of the pairs of each sentence -> [batch, max number of pair, 2],
+        # padded with (0, 1)
+        # returns the padded index on the host and the number of pairs of each sentence
+        batch_sent_len_list = [len(sent_entity_pair_list) for sent_entity_pair_list in batch_entity_pair_list]
+        batch_pair_index = np.zeros((len(batch_entity_pair_list), max(batch_sent_len_list + [1]), 2), dtype=np.int64)
+        batch_pair_index[:, :, 1] = 1
+        for sent_index, sent_entity_pair_list in enumerate(batch_entity_pair_list):
+            if sent_entity_pair_list:
+                batch_pair_index[sent_index, :len(sent_entity_pair_list)] = sent_entity_pair_list
+        return batch_pair_index, batch_sent_len_list
+
+    def get_packed_pair_position(self, batch_sent_len_list):
+        # position of every real pair in the padded [batch, max number of pair] layout, sentence after sentence
+        max_pair_num = max(batch_sent_len_list + [1])
+        pair_mask = np.arange(max_pair_num)[None, :] < np.array(batch_sent_len_list)[:, None]
+        return np.flatnonzero(pair_mask)
+
+    def get_entity_rep(self, common_embedding, batch_entity_spans):
+        # batch_entity_spans: [batch, max number of entity, 2] (head, tail), padded with -1
+        # returns [batch, max number of entity, hidden], every entity is pooled once
+        entity_spans = batch_entity_spans.clamp(min=0).long()
         if self.args.Entity_Prep_Way == "entity_type_marker":
-            entity_1 = sentence_embedding[entity_1_head]
-            entity_2 = sentence_embedding[entity_2_head]
+            return common_embedding.gather(1, entity_spans[:, :, 0:1].expand(-1, -1, common_embedding.shape[-1]))
         elif self.args.Entity_Prep_Way == "standard":
-            entity_1 = torch.sum(sentence_embedding[entity_1_head:entity_1_tail], dim=0).squeeze()
-            entity_2 = torch.sum(sentence_embedding[entity_2_head:entity_2_tail], dim=0).squeeze()
+            # sum of the embeddings from head to tail (tail excluded), as a difference of prefix sums
+            prefix_sum = F.pad(torch.cumsum(common_embedding, dim=1), (0, 0, 1, 0))
+            hidden_size = common_embedding.shape[-1]
+            return prefix_sum.gather(1, entity_spans[:, :, 1:2].expand(-1, -1, hidden_size)) - \
+                prefix_sum.gather(1, entity_spans[:, :, 0:1].expand(-1, -1, hidden_size))
         else:
             raise Exception("args.Entity_Prep_Way error !")
 
-        entity_pair_rep = torch.cat((entity_1, entity_2))
-        return entity_pair_rep
-
-    def batch_get_entity_pair_rep(self, batch_tokens, batch_entity, batch_entity_type):
+    def get_entity_pair_rep(self, common_embedding, batch_entity_spans, batch_pair_index, batch_sent_len_list):
+        # batch_pair_index: [batch, max number of pair, 2] entity indices of each pair
+        # returns [batch, max number of pair, 2 * hidden], padded pairs are 0
+        batch_size, max_pair_num, _ = batch_pair_index.shape
+        entity_rep = self.get_entity_rep(common_embedding, batch_entity_spans)
+        if entity_rep.shape[1] < 2:
+            entity_rep = F.pad(entity_rep, (0, 0, 0, 2 - entity_rep.shape[1]))
+
+        entity_pair_rep = entity_rep.gather(
+            1, batch_pair_index.view(batch_size, -1, 1).expand(-1, -1, entity_rep.shape[-1]))
+        entity_pair_rep = entity_pair_rep.view(batch_size, max_pair_num, -1)
+        pair_mask = torch.arange(max_pair_num, device=self.device).unsqueeze(0) < \
+            torch.tensor(batch_sent_len_list, device=self.device).unsqueeze(1)
+        return entity_pair_rep.masked_fill(~pair_mask.unsqueeze(-1), 0)
+
+    def get_packed_entity_pair_rep(self, common_embedding, batch_entity_spans, packed_pair_index):
+        # packed_pair_index: [total number of pair, 3] (sentence index, entity index, entity index)
+        # returns [total number of pair, 2 * hidden], no padded pair
+        entity_rep = self.get_entity_rep(common_embedding, batch_entity_spans)
+        sent_index = packed_pair_index[:, 0]
+        return torch.cat([entity_rep[sent_index, packed_pair_index[:, 1]],
+                          entity_rep[sent_index, packed_pair_index[:, 2]]], dim=-1)
+
+    def batch_get_entity_pair_rep(self, batch_tokens, batch_entity_pair_list, batch_entity_spans,
+                                  batch_marked_tokens, batch_marked_entity_spans):
+        # batch_entity_pair_list: the candidate pairs (entity index, entity index) of each sentence
+        # returns [batch, max number of pair, dim], or [total number of pair, dim] with args.Packed_pairs
         padding_value = self.tokenizer.vocab['[PAD]']
+        batch_pair_index, batch_sent_len_list = self.get_entity_pair_index(batch_entity_pair_list)
 
         if self.args.Entity_Prep_Way == "entity_type_marker":
-            raw_batch_entity = copy.deepcopy(batch_entity)
-            batch_tokens_marker = []
-            for sent_index, (one_sent_tokens, one_sent_entity, one_sent_entity_type) in enumerate(
-                    zip(batch_tokens, batch_entity, batch_entity_type)):
-                temp_token_list = one_sent_tokens.tolist()
-                for entity_index, (span, entity_type) in enumerate(zip(one_sent_entity, one_sent_entity_type)):
-                    temp_token_list.insert(span[0], self.tokenizer.convert_tokens_to_ids("[Entity_" + entity_type + "]"))
-                    temp_token_list.insert(span[-1] + 2, self.tokenizer.convert_tokens_to_ids("[/Entity_" + entity_type + "]"))
-
-                    batch_entity[sent_index][entity_index].insert(0, span[0])
-                    batch_entity[sent_index][entity_index].append(span[-1] + 2)
-
-                    # need batch_span is in order in entity list
-                    batch_entity[sent_index][entity_index + 1:] = [[j + 2 for j in i] for i in
-                                                                   batch_entity[sent_index][entity_index + 1:]]
-                    batch_entity[sent_index][entity_index][1:-1] = [i + 1 for i in
-                                                                    batch_entity[sent_index][entity_index][1:-1]]
-                batch_tokens_marker.append(torch.tensor(temp_token_list, device=self.device))
-
-            common_embedding = self.forward(
-                pad_sequence(batch_tokens_marker, batch_first=True, padding_value=padding_value),
-                encoder_hidden_states=None)
-
-            batch_entity_pair_span_list = []
-            batch_entity_pair_vec_list = []
-            batch_sent_len_list = []
-
-            for sent_index, (raw_one_sent_entity, one_sent_entity, one_sent_entity_type) in enumerate(
-                    zip(raw_batch_entity, batch_entity, batch_entity_type)):
-                sent_entity_pair_span_list = list(combinations(one_sent_entity, 2))
-                sent_entity_pair_span_list = [sorted(i) for i in sent_entity_pair_span_list]
-                batch_sent_len_list.append(len(sent_entity_pair_span_list))
-
-                raw_sent_entity_pair_span_list = list(combinations(raw_one_sent_entity, 2))
-                raw_sent_entity_pair_span_list = [sorted(i) for i in raw_sent_entity_pair_span_list]
-                batch_entity_pair_span_list.append(raw_sent_entity_pair_span_list)
-
-                sent_entity_pair_rep_list = []
-                if sent_entity_pair_span_list:
-                    for entity_pair_span in sent_entity_pair_span_list:
-                        one_sent_rep = self.get_entity_pair_rep(entity_pair_span, common_embedding[sent_index])
-                        sent_entity_pair_rep_list.append(one_sent_rep)
-                else:
-                    sent_entity_pair_rep_list.append(torch.tensor([0] * self.output_dim * 2).float().to(self.device))
-
-                batch_entity_pair_vec_list.append(torch.stack(sent_entity_pair_rep_list))
-
-            batch_added_marker_entity_span_vec = pad_sequence(batch_entity_pair_vec_list,
-                                                              batch_first=True, padding_value=padding_value)
-
-            batch_added_marker_entity_span_vec = self.linear_transform(batch_added_marker_entity_span_vec)
-            batch_added_marker_entity_span_vec = F.gelu(batch_added_marker_entity_span_vec)
-            batch_added_marker_entity_span_vec = self.layer_normalization(batch_added_marker_entity_span_vec)
-
-            return batch_added_marker_entity_span_vec, batch_entity_pair_span_list, batch_sent_len_list
-
+            # batch_marked_tokens and batch_marked_entity_spans (start marker, end marker) are prepared by the dataset
+            common_embedding = self.forward_sentences_with_pair(batch_marked_tokens, batch_sent_len_list)
+            entity_spans = batch_marked_entity_spans
         elif self.args.Entity_Prep_Way == "standard":
-            common_embedding = self.forward(batch_tokens, encoder_hidden_states=None, ignore_index=padding_value)
-            batch_entity_pair_span_list = []
-            batch_entity_pair_vec_list = []
-            batch_sent_len_list = []
-
-            for sent_index, (one_sent_entity, one_sent_entity_type) in enumerate(zip(batch_entity, batch_entity_type)):
-                sent_entity_pair_span_list = list(combinations(one_sent_entity, 2))
-                batch_sent_len_list.append(len(sent_entity_pair_span_list))
-                sent_entity_pair_span_list = [sorted(i) for i in sent_entity_pair_span_list]
-
-                sent_entity_pair_rep_list = []
-                if sent_entity_pair_span_list:
-                    for entity_pair_span in sent_entity_pair_span_list:
-                        one_sent_rep = self.get_entity_pair_rep(entity_pair_span, common_embedding[sent_index])
-                        sent_entity_pair_rep_list.append(one_sent_rep)
-                else:
-                    sent_entity_pair_rep_list.append(
-                        torch.tensor([0] * self.relation_input_dim).float().to(self.device))
-
-                batch_entity_pair_vec_list.append(torch.stack(sent_entity_pair_rep_list))
-                batch_entity_pair_span_list.append(sent_entity_pair_span_list)
-            batch_added_marker_entity_span_vec = pad_sequence(batch_entity_pair_vec_list,
-                                                              batch_first=True, padding_value=padding_value)
-
-            return batch_added_marker_entity_span_vec, batch_entity_pair_span_list, batch_sent_len_list
+            common_embedding = self.forward_sentences_with_pair(batch_tokens, batch_sent_len_list,
+                                                                ignore_index=padding_value)
+            entity_spans = batch_entity_spans
         else:
             raise Exception("Entity_Prep_Way wrong !")
 
-    def memory_get_entity_pair_rep(self, batch_entity, batch_tokens, batch_entity_type, batch_gold_RE):
-        padding_value = self.tokenizer.vocab['[PAD]']
-
-        raw_batch_entity = copy.deepcopy(batch_entity)
-        batch_tokens_marker = []
-        for sent_index, (one_sent_tokens, one_sent_entity, one_sent_type) in enumerate(
-                zip(batch_tokens, batch_entity, batch_entity_type)):
-            temp_token_list = one_sent_tokens.tolist()
-            for entity_index, (span, entity_type) in enumerate(zip(one_sent_entity, one_sent_type)):
-                temp_token_list.insert(span[0], self.tokenizer.convert_tokens_to_ids("[Entity_" + entity_type + "]"))
-                temp_token_list.insert(span[-1] + 2, self.tokenizer.convert_tokens_to_ids("[/Entity_" + entity_type + "]"))
+        if self.args.Packed_pairs:
+            packed_position = self.get_packed_pair_position(batch_sent_len_list)
+            packed_pair_index = np.concatenate([(packed_position // batch_pair_index.shape[1])[:, None],
+                                                batch_pair_index.reshape(-1, 2)[packed_position]], axis=1)
+            packed_pair_index = torch.from_numpy(packed_pair_index).to(self.device, non_blocking=True)
+            batch_added_marker_entity_span_vec = self.get_packed_entity_pair_rep(common_embedding, entity_spans,
+                                                                                 packed_pair_index)
+        else:
+            batch_pair_index = torch.from_numpy(batch_pair_index).to(self.device, non_blocking=True)
+            batch_added_marker_entity_span_vec = self.get_entity_pair_rep(common_embedding, entity_spans,
+                                                                          batch_pair_index, batch_sent_len_list)
 
-                batch_entity[sent_index][entity_index].insert(0, span[0])
-                batch_entity[sent_index][entity_index].append(span[-1] + 2)
+        if self.args.Entity_Prep_Way == "entity_type_marker":
+            batch_added_marker_entity_span_vec = self.linear_transform(batch_added_marker_entity_span_vec)
+            batch_added_marker_entity_span_vec = F.gelu(batch_added_marker_entity_span_vec)
+            batch_added_marker_entity_span_vec = self.layer_normalization(batch_added_marker_entity_span_vec)
 
-                # need batch_span is in order in entity list
-                batch_entity[sent_index][entity_index + 1:] = [[j + 2 for j in i] for i in
-                                                               batch_entity[sent_index][entity_index + 1:]]
-                batch_entity[sent_index][entity_index][1:-1] = [i + 1 for i in
-                                                                batch_entity[sent_index][entity_index][1:-1]]
-            batch_tokens_marker.append(torch.tensor(temp_token_list, device=self.device))
+        return batch_added_marker_entity_span_vec, batch_sent_len_list
 
-        common_embedding = self.forward(pad_sequence(batch_tokens_marker, batch_first=True, padding_value=padding_value))
+    def memory_get_entity_pair_rep(self, batch_entity, batch_marked_tokens, batch_marked_entity_spans, batch_gold_RE):
+        common_embedding = self.forward(batch_marked_tokens)
 
+        # only the entity pairs having a relation
         batch_entity_pair_span_list = []
-        batch_entity_pair_vec_list = []
-        batch_sent_len_list = []
-
-        for sent_index, (raw_one_sent_entity, one_sent_entity, one_sent_type) in enumerate(
-                zip(raw_batch_entity, batch_entity, batch_entity_type)):
-            temp_sent_entity_pair_span_list = list(combinations(one_sent_entity, 2))
-            temp_sent_entity_pair_span_list = [sorted(i) for i in temp_sent_entity_pair_span_list]
-
-            temp_raw_sent_entity_pair_span_list = list(combinations(raw_one_sent_entity, 2))
-            temp_raw_sent_entity_pair_span_list = [sorted(i) for i in temp_raw_sent_entity_pair_span_list]
-
+        batch_pair_index_list = []
+        for sent_index, one_sent_entity in enumerate(batch_entity):
             sent_entity_pair_span_list = []
-            raw_sent_entity_pair_span_list = []
-            for idx, entity_pair_span in enumerate(temp_raw_sent_entity_pair_span_list):
+            sent_pair_index_list = []
+            for i, j in combinations(range(len(one_sent_entity)), 2):
+                entity_pair_span = sorted([one_sent_entity[i], one_sent_entity[j]])
                 if entity_pair_span in batch_gold_RE[sent_index]:
-                    sent_entity_pair_span_list.append(temp_sent_entity_pair_span_list[idx])
-                    raw_sent_entity_pair_span_list.append(temp_raw_sent_entity_pair_span_list[idx])
-            batch_sent_len_list.append(len(sent_entity_pair_span_list))
-
-            batch_entity_pair_span_list.append(raw_sent_entity_pair_span_list)
-
-            sent_entity_pair_rep_list = []
-            if sent_entity_pair_span_list:
-                for entity_pair_span in sent_entity_pair_span_list:
-                    one_sent_rep = self.get_entity_pair_rep(entity_pair_span, common_embedding[sent_index])
-                    sent_entity_pair_rep_list.append(one_sent_rep)
-            else:
-                sent_entity_pair_rep_list.append(
-                    torch.tensor([0] * self.output_dim * 2).float().to(self.device))
-
-            batch_entity_pair_vec_list.append(torch.stack(sent_entity_pair_rep_list))
-
-        batch_added_marker_entity_span_vec = pad_sequence(batch_entity_pair_vec_list,
-                                                          batch_first=True, padding_value=padding_value)
+                    sent_entity_pair_span_list.append(entity_pair_span)
+                    sent_pair_index_list.append((i, j))
+            batch_entity_pair_span_list.append(sent_entity_pair_span_list)
+            batch_pair_index_list.append(sent_pair_index_list)
+        batch_pair_index, batch_sent_len_list = self.get_entity_pair_index(batch_pair_index_list)
+
+        batch_added_marker_entity_span_vec = self.get_entity_pair_rep(
+            common_embedding, batch_marked_entity_spans,
+            torch.from_numpy(batch_pair_index).to(self.device, non_blocking=True), batch_sent_len_list)
 
         batch_added_marker_entity_span_vec = self.linear_transform(batch_added_marker_entity_span_vec)
         batch_added_marker_entity_span_vec = F.gelu(batch_added_marker_entity_span_vec)
@@ -1,5 +1,7 @@
+import numpy as np
+import torch
 import torch.nn as nn
-from utils import get_sent_len
+from utils import sync_counter
 
 
 class MyModel(nn.Module):
@@ -11,107 +13,96 @@ class MyModel(nn.Module):
         self.classifier = classifier
 
     def get_relation_data(self, batch):
-        batch_entity = []
-        batch_entity_type = []
-
-        batch_entity_type_gold = self.entity_type_extraction(batch)
-        TAGS_field = self.classifier.TAGS_sep_entity_fields_dic["sep_entity"][1]
-
-        for sent_index, one_sent_entity in enumerate(batch.sep_entity):
-            one_sent_temp_list = one_sent_entity[:get_sent_len(one_sent_entity, TAGS_field)]  # deal with PAD
-            one_sent_temp_list = [eval(TAGS_field.vocab.itos[int(i)]) for i in one_sent_temp_list.cpu().numpy().tolist()]
-            batch_entity.append(sorted(one_sent_temp_list, key=lambda s: s[0]))
-
-            type_dic = batch_entity_type_gold[sent_index]
-
-            batch_entity_type.append(self.provide_dic_entity_type(one_sent_temp_list, type_dic))
-
-        assert len(batch_entity) == len(batch_entity_type)
-        return batch_entity, batch_entity_type
-
-    def provide_dic_entity_type(self, entity_list, type_dic):
-        entity_type_list = []
-        for entity in entity_list:
-            add_flag = False
-            for k, v in type_dic.items():
-                if entity in v:
-                    entity_type_list.append(k)
-                    add_flag = True
-                    break
-            if not add_flag:
-                entity_type_list.append("None")
-        assert len(entity_type_list) == len(entity_list)
-        return entity_type_list
-
-    def forward(self, batch):
-        batch_entity, batch_entity_type = self.get_relation_data(batch)
-        batch_res, batch_loss = self.relation_extraction(batch, batch_entity, batch_entity_type)
-        return batch_loss, batch_res
-
-    def entity_type_extraction(self, batch):
-        batch_entity_type_gold = []
-        for sent_index in range(len(batch)):
-            gold_one_sent_all_sub_task_res_dic = {}
-            for entity_type in self.classifier.entity_type_list:
-                gold_one_sent_all_sub_task_res_dic.setdefault(entity_type, [])
-                for entity in getattr(batch, entity_type)[sent_index]:
-                    entity_span = self.classifier.TAGS_Entity_Type_fields_dic[entity_type][1].vocab.itos[entity]
-                    if str(entity_span) != '[PAD]':
-                        temp_pair = sorted(eval(entity_span))
-                        if temp_pair not in gold_one_sent_all_sub_task_res_dic[entity_type]:
-                            gold_one_sent_all_sub_task_res_dic[entity_type].append(temp_pair)
-            batch_entity_type_gold.append(gold_one_sent_all_sub_task_res_dic)
-
-        return batch_entity_type_gold
-
-    def relation_extraction(self, batch, batch_entity, batch_entity_type):
-        """ Relation extraction """
-
-        batch_added_marker_entity_vec, batch_entity_pair_list, batch_sent_len_list = \
-            self.encoder.batch_get_entity_pair_rep(batch.tokens, batch_entity, batch_entity_type)
-
-        batch_pred_raw_res_list, batch_pred_for_loss_sub_task_list = self.classifier(batch_added_marker_entity_vec)
-
-        batch_gold_res_list = []
-        for sent_index in range(len(batch)):
-            gold_one_sent_all_sub_task_res_dic = {}
-            for relation in self.classifier.relation_list:
-                gold_one_sent_all_sub_task_res_dic.setdefault(relation, [])
-
-                for entity_pair in getattr(batch, relation)[sent_index]:
-                    entity_pair = self.classifier.TAGS_Types_fields_dic[relation][1].vocab.itos[entity_pair]
-                    if entity_pair != "[PAD]":
-                        temp_pair = sorted(eval(entity_pair))
-                        if temp_pair not in gold_one_sent_all_sub_task_res_dic[relation]:
-                            gold_one_sent_all_sub_task_res_dic[relation].append(temp_pair)
-
-            batch_gold_res_list.append(gold_one_sent_all_sub_task_res_dic)
-
-        batch_pred_res_list = []
-        for sent_index in range(len(batch)):
-            sent_len = batch_sent_len_list[sent_index]
-            pred_one_sent_all_sub_task_res_dic = {}
-            for relation_index, relation in enumerate(self.classifier.relation_list):
-                pred_one_sent_all_sub_task_res_dic.setdefault(relation, [])
-                for entity_pair, pred_type in zip(batch_entity_pair_list[sent_index][:sent_len],
-                                                  batch_pred_raw_res_list[sent_index][:sent_len]):
-                    if pred_type == relation_index:
-                        pred_one_sent_all_sub_task_res_dic[relation].append(entity_pair)
-            batch_pred_res_list.append(pred_one_sent_all_sub_task_res_dic)
-
-        batch_gold_for_loss_sub_task_tensor = self.classifier.make_gold_for_loss(
-            batch_gold_res_list, batch_entity_pair_list,
-            self.classifier.TAGS_my_types_classification.vocab)
-
-        if self.classifier.args.Loss == "CE":
-            one_batch_relation_loss = self.classifier.get_ensembled_ce_loss(batch_pred_for_loss_sub_task_list,
-                                                                            batch_gold_for_loss_sub_task_tensor)
+        # sorted entity spans of each sentence, decoded once per example by the dataset
+        return batch.entity_list
+
+    def get_gold_relation(self, batch):
+        # relation -> gold entity pair spans of each sentence, decoded once per example by the dataset
+        return batch.gold_relation_list
+
+    def forward(self, batch, source_lens=None):
+        batch_relation_TP_FN_FP, batch_loss = self.relation_extraction(batch, source_lens)
+        return batch_loss, batch_relation_TP_FN_FP
+
+    def get_loss(self, batch_pred_logits, batch_gold_for_loss_sub_task_tensor):
+        if not batch_gold_for_loss_sub_task_tensor.shape[1]:
+            # packed pairs, no pair in the whole batch
+            return batch_pred_logits.sum()
+        elif self.classifier.args.Loss == "CE":
+            return self.classifier.get_ensembled_ce_loss(batch_pred_logits, batch_gold_for_loss_sub_task_tensor)
         elif self.classifier.args.Loss == "BCE":
-            one_batch_relation_loss = self.classifier.BCE_loss(batch_pred_for_loss_sub_task_list,
-                                                               batch_gold_for_loss_sub_task_tensor)
+            return self.classifier.BCE_loss(batch_pred_logits, batch_gold_for_loss_sub_task_tensor)
         else:
             raise Exception("Choose loss error !")
 
-        one_batch_relation_res = (batch_gold_res_list, batch_pred_res_list)
+    def get_relation_TP_FN_FP(self, pred_type_tensor, batch_gold_tensor, batch_gold_relation_nums, pair_sent_index=None):
+        # pred_type_tensor: [batch, number of pair] (or [total number of pair] with the sentence of each pair in
+        # pair_sent_index), relation index, number_of_relation for none. batch_gold_tensor: [number_of_relation, ...]
+        # labels of the same pairs. batch_gold_relation_nums: [batch, number_of_relation], gold pairs of each sentence,
+        # filtered pairs included
+        # returns [batch, number_of_relation, 3] (TP, FN, FP) of each sentence on the device
+        relation_num = batch_gold_tensor.shape[0]
+        relation_index = torch.arange(relation_num, device=pred_type_tensor.device)
+        pred_mask = pred_type_tensor.unsqueeze(0) == relation_index.view((-1,) + (1,) * pred_type_tensor.dim())
+        pred_mask &= (batch_gold_tensor[0] != self.classifier.ignore_index).unsqueeze(0)
+        TP_mask = pred_mask & (batch_gold_tensor == self.classifier.yes_no_vocab["yes"])
+
+        if pair_sent_index is None:
+            TP = TP_mask.sum(2).t()
+            pred_num = pred_mask.sum(2).t()
+        else:
+            TP = torch.zeros_like(batch_gold_relation_nums).index_add_(0, pair_sent_index, TP_mask.t().long())
+            pred_num = torch.zeros_like(batch_gold_relation_nums).index_add_(0, pair_sent_index, pred_mask.t().long())
+        return torch.stack([TP, batch_gold_relation_nums - TP, pred_num - TP], dim=2)
 
-        return one_batch_relation_res, one_batch_relation_loss
+    def relation_extraction(self, batch, source_lens=None):
+        """ Relation extraction """
+        # source_lens: number of examples of each source (e.g. replay, current task) mixed in the batch, one after
+        # the other, the loss of each source is then returned separately: [number of source]
+        with sync_counter.stage("encoder"):
+            batch_added_marker_entity_vec, batch_sent_len_list = \
+                self.encoder.batch_get_entity_pair_rep(batch.tokens, batch.entity_pair_list, batch.entity_spans,
+                                                       batch.marked_tokens, batch.marked_entity_spans)
+
+        # [number_of_relation, batch, max(number of entity_pair)], built by the dataset
+        batch_gold_for_loss_sub_task_tensor = batch.relation_labels
+        pair_sent_index = None
+        if self.args.Packed_pairs:
+            # [number_of_relation, total number of pair], the padded pairs are not in the loss
+            packed_position = self.encoder.get_packed_pair_position(batch_sent_len_list)
+            pair_sent_index = torch.from_numpy(packed_position // batch_gold_for_loss_sub_task_tensor.shape[-1])
+            batch_gold_for_loss_sub_task_tensor = batch_gold_for_loss_sub_task_tensor.flatten(1)[
+                :, torch.from_numpy(packed_position).to(batch_gold_for_loss_sub_task_tensor.device, non_blocking=True)]
+            pair_sent_index = pair_sent_index.to(batch_gold_for_loss_sub_task_tensor.device, non_blocking=True)
+
+        with sync_counter.stage("classifier"):
+            batch_pred_raw_res_list, batch_pred_logits = \
+                self.classifier(batch_added_marker_entity_vec,
+                                batch_gold_for_loss_sub_task_tensor != self.classifier.not_allowed_index)
+
+        with sync_counter.stage("metric"):
+            batch_relation_TP_FN_FP = self.get_relation_TP_FN_FP(batch_pred_raw_res_list,
+                                                                 batch_gold_for_loss_sub_task_tensor,
+                                                                 batch.gold_relation_nums, pair_sent_index)
+
+        with sync_counter.stage("loss"):
+            if source_lens is None:
+                one_batch_relation_loss = self.get_loss(batch_pred_logits, batch_gold_for_loss_sub_task_tensor)
+            else:
+                # the sentences of a source are consecutive, and so are their pairs when packed. Unpacked, a source
+                # is cut to its own max number of pairs, so its loss is the one of a batch of its own
+                sent_offsets = np.cumsum([0] + list(source_lens)).tolist()
+                pair_offsets = np.cumsum([0] + batch_sent_len_list).tolist()
+                source_loss_list = []
+                for start, end in zip(sent_offsets[:-1], sent_offsets[1:]):
+                    if self.args.Packed_pairs:
+                        source_index = (slice(None), slice(pair_offsets[start], pair_offsets[end]))
+                    else:
+                        source_index = (slice(None), slice(start, end),
+                                        slice(0, max(batch_sent_len_list[start:end] + [1])))
+                    source_loss_list.append(self.get_loss(batch_pred_logits[source_index],
+                                                          batch_gold_for_loss_sub_task_tensor[source_index]))
+                one_batch_relation_loss = torch.stack(source_loss_list)
+
+        # TP, FN, FP of each sentence and relation, the predictions never leave the device
+        return batch_relation_TP_FN_FP, one_batch_relation_loss
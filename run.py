@@ -1,26 +1,27 @@
 #!/usr/bin/python3.7
 # -*- coding: utf-8 -*-
 import pickle
+import queue
 import warnings
 import sys
 import argparse
 import os
 import copy
 import random
+from collections import OrderedDict
 import numpy as np
-import torchtext
 from sklearn.cluster import KMeans
-from torchtext.legacy.data import Batch
 import torch
 import transformers
 import torch.optim as optim
 
-from utils import print_execute_time, Logger
-from metric import report_performance, record_detail_performance
+from utils import print_execute_time, Logger, sync_counter, AsyncCheckpointWriter
+from metric import report_performance, record_detail_performance, StreamingRelationCounter
 from model.my_model import MyModel
 from model.my_encoder import MyEncoder
 from model.my_classifier import MyRelationClassifier
-from data_loader import prepared_data, get_corpus_list_information, make_model_data
+from data_loader import prepared_data, get_corpus_list_information, make_model_data, BatchIterator, \
+    BucketBatchSampler, ReplayBuffer, get_relation_signature_dic
 
 parser = argparse.ArgumentParser(description="Bert model")
 parser.add_argument('--ID', default=0, type=int, help="model's ID")
@@ -28,15 +29,40 @@ parser.add_argument('--BERT_MODEL', default="base", type=str, help="base, large"
 parser.add_argument('--GPU', default="0", type=str)
 parser.add_argument('--ALL_DATA', action='store_true', default=False)
 parser.add_argument('--BATCH_SIZE', default=8, type=int)
+parser.add_argument('--NUM_WORKERS', default=2, type=int, help="processes collating batches, 0 for main process")
+parser.add_argument('--PREFETCH_FACTOR', default=2, type=int, help="batches prefetched by each worker")
+parser.add_argument('--Batch_way', default="bucket", type=str,
+                    help="\"bucket\": group examples of similar length and entity pairs, \"random\"")
+parser.add_argument('--MAX_TOKENS', default=0, type=int,
+                    help="budget of (padded) marked tokens in a batch instead of --BATCH_SIZE, 0 for no budget")
+parser.add_argument('--MAX_PAIRS', default=0, type=int,
+                    help="budget of (padded) entity pairs in a batch instead of --BATCH_SIZE, 0 for no budget")
 
 parser.add_argument('--EPOCH', default=30, type=int)
 parser.add_argument('--MIN_EPOCH_VALID', default=5, type=int)
 parser.add_argument('--EARLY_STOP_NUM', default=5, type=int)
 parser.add_argument('--MEMORY_SIZE', default=100, type=int)
+parser.add_argument('--Replay_balanced', action='store_true', default=False,
+                    help="the memorized corpora take turns in a replay batch")
+parser.add_argument('--Replay_prebuilt_batches', default=0, type=int,
+                    help="replay batches collated once per corpus and drawn at random, 0 for a fresh batch each step")
+parser.add_argument('--Replay_mode', default="sequential", type=str,
+                    help="\"sequential\": a replay step then a current step, "
+                         "\"fused\": one step on a batch mixing the replay and current examples")
+parser.add_argument('--Replay_loss_weight', default=0.3, type=float)
+parser.add_argument('--Train_loss_weight', default=0.3, type=float)
 
 parser.add_argument('--Corpus_list', default=["Combine_ADE", "DDI", "CPR"], nargs='+',
                     help="\"DDI\", \"Twi_ADE\", \"ADE\", \"CPR\", \"PPI\"")
 parser.add_argument('--Only_test', action='store_true', default=False)
+parser.add_argument('--Async_valid', action='store_true', default=False,
+                    help="validate snapshots of the weights on the CPU in a background process while training goes on")
+parser.add_argument('--Valid_max_lag', default=1, type=int,
+                    help="epochs the training may run ahead of the background validation")
+parser.add_argument('--Valid_threads', default=0, type=int,
+                    help="CPU threads of the background validation, 0 for the torch default")
+parser.add_argument('--Sync_debug', action='store_true', default=False,
+                    help="count the device-to-host syncs of each stage, cuda only")
 
 parser.add_argument('--Entity_Prep_Way', default="entity_type_marker", type=str,
                     help="\"standard\" or \"entity_type_marker\"")
@@ -47,6 +73,15 @@ parser.add_argument('--L2', default=1e-2, type=float)
 
 parser.add_argument('--Weight_Loss', action='store_true', default=True)
 parser.add_argument('--Loss', type=str, default="BCE", help="\"BCE\", \"CE\"")
+parser.add_argument('--Pair_type_filter', action='store_true', default=False,
+                    help="only classify the entity pairs whose types match a relation_signature of corpus_information")
+parser.add_argument('--Max_pair_distance', default=0, type=int,
+                    help="only classify the entity pairs at most this many tokens apart, 0 for no limit")
+parser.add_argument('--Packed_pairs', action='store_true', default=False,
+                    help="flatten the pairs of the batch without padding for the head and the loss, "
+                         "BCE loss no longer counts padded pairs")
+parser.add_argument('--Fused_head', action='store_true', default=False,
+                    help="evaluate the heads of all relations in one batched op, loads per relation checkpoints")
 parser.add_argument('--Min_weight', default=0.5, type=float)
 parser.add_argument('--Max_weight', default=5, type=float)
 
@@ -74,6 +109,8 @@ elif args.BERT_MODEL == "base":
 # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 torch.backends.cudnn.benchmark = True
 device = torch.device("cuda")
+if args.Sync_debug:
+    sync_counter.enable(device)
 SEED = 1234
 torch.manual_seed(SEED)
 torch.cuda.manual_seed(SEED)
@@ -95,13 +132,98 @@ def select_data(all_embedding_representations):
     return mem_set
 
 
+def get_cpu_state_dic(model):
+    state_dic = model.state_dict()
+    cpu_state_dic = OrderedDict((name, tensor.detach().to("cpu", copy=True)) for name, tensor in state_dic.items())
+    if hasattr(state_dic, "_metadata"):
+        cpu_state_dic._metadata = state_dic._metadata
+    return cpu_state_dic
+
+
+def get_cpu_copy(value):
+    # tensors of nested dicts / lists (e.g. the optimizer state) copied to the CPU
+    if torch.is_tensor(value):
+        return value.detach().to("cpu", copy=True)
+    if isinstance(value, dict):
+        return {key: get_cpu_copy(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(get_cpu_copy(item) for item in value)
+    return value
+
+
+def get_cpu_model_copy(model):
+    # a model built on the CPU and loaded with a CPU copy of the weights, the device model is never duplicated
+    cpu_device = torch.device("cpu")
+    bert = transformers.BertModel(model.encoder.bert.config)
+    cpu_model = MyModel(MyEncoder(bert, model.encoder.tokenizer, args, cpu_device),
+                        MyRelationClassifier(args, cpu_device), args, cpu_device)
+    cpu_model.classifier.create_classifiers(model.classifier.relation_list, model.classifier.entity_type_list)
+    cpu_model.load_state_dict(get_cpu_state_dic(model))
+    return cpu_model
+
+
+class BackgroundValidator:
+    # validates CPU snapshots of the weights in a forked process (the forked copy of train_valid_test) while the
+    # training goes on, the results come back in the order of submission with the training state of their epoch
+    def __init__(self, train_valid_test):
+        context = torch.multiprocessing.get_context("fork")
+        self.job_queue = context.Queue()
+        self.result_queue = context.Queue()
+        self.pending_list = []
+        # results of discarded epochs still to come out of result_queue, they are skipped
+        self.discarded_num = 0
+        self.process = context.Process(target=train_valid_test.valid_worker_loop,
+                                       args=(get_cpu_model_copy(train_valid_test.my_model), self.job_queue,
+                                             self.result_queue),
+                                       daemon=True)
+        self.process.start()
+
+    def __len__(self):
+        return len(self.pending_list)
+
+    def submit(self, epoch, valid_corpus_list, training_state_dic):
+        self.pending_list.append((epoch, training_state_dic))
+        self.job_queue.put((epoch, valid_corpus_list, training_state_dic["my_model"]))
+
+    def get_queue_result(self):
+        while True:
+            try:
+                return self.result_queue.get(timeout=10)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise Exception("Background validation process died !")
+
+    def skip_discarded_results(self):
+        while self.discarded_num:
+            self.get_queue_result()
+            self.discarded_num -= 1
+
+    def get_result(self):
+        self.skip_discarded_results()
+        epoch, training_state_dic = self.pending_list.pop(0)
+        _, dic_valid_loss, valid_relation_TP_FN_FP_list = self.get_queue_result()
+        return epoch, training_state_dic, dic_valid_loss, valid_relation_TP_FN_FP_list
+
+    def discard_pending(self):
+        # the pending epochs (and their training states) are dropped without waiting for their results
+        self.discarded_num += len(self.pending_list)
+        self.pending_list = []
+
+    def close(self):
+        self.discard_pending()
+        self.job_queue.put(None)
+        # the results left in result_queue are read, otherwise the process could not flush them and exit
+        self.skip_discarded_results()
+        self.process.join()
+
+
 class TrainValidTest:
     def __init__(self, ID_to_corpus_dic, my_model,
                  train_dataset, valid_dataset, test_dataset,
                  corpus_information, relation_list):
 
         self.my_model = my_model.to(device)
-        self.model_state_dic = {}
+        self.checkpoint_writer = AsyncCheckpointWriter()
 
         self.ID_to_corpus_dic = ID_to_corpus_dic
 
@@ -109,19 +231,28 @@ class TrainValidTest:
         self.valid_dataset = valid_dataset
         self.test_dataset = test_dataset
 
-        self.train_corpus_to_examples_dic = self.get_corpus_to_examples(train_dataset)
-        self.valid_corpus_to_examples_dic = self.get_corpus_to_examples(valid_dataset)
-        self.test_corpus_to_examples_dic = self.get_corpus_to_examples(test_dataset)
+        self.train_sequence_lengths = train_dataset.get_sequence_lengths(args.Entity_Prep_Way == "entity_type_marker")
 
-        self.train_iterator = None
-        self.valid_iterator = None
-        self.test_iterator = None
+        self.dataset_dic = {"train": train_dataset, "valid": valid_dataset, "test": test_dataset}
+        # read-only dataset indices of every corpus, the datasets themselves are never modified
+        self.corpus_to_indices_dic = {split: self.get_corpus_to_indices(dataset)
+                                      for split, dataset in self.dataset_dic.items()}
+        # position in args.Corpus_list of the corpus of every example, to break the metrics down by corpus
+        self.example_corpus_index_dic = {
+            split: self.get_example_corpus_index(dataset, self.corpus_to_indices_dic[split])
+            for split, dataset in self.dataset_dic.items()}
+        # (split, tuple of corpus) -> BatchIterator, built the first time it is used
+        self.iterator_cache_dic = {}
+        self.background_validator = None
 
         self.corpus_information = corpus_information
         self.relation_list = relation_list
 
         self.memorized_samples = {}
-        self.total_memorized_samples = []
+        self.replay_buffer = ReplayBuffer(train_dataset, self.train_sequence_lengths, args.BATCH_SIZE, device,
+                                          max_tokens=args.MAX_TOKENS, max_pairs=args.MAX_PAIRS,
+                                          balanced=args.Replay_balanced,
+                                          prebuilt_batch_num=args.Replay_prebuilt_batches)
 
         self.optimizer_encoder = optim.AdamW(
             params=filter(lambda p: p.requires_grad, self.my_model.encoder.parameters()),
@@ -131,193 +262,310 @@ class TrainValidTest:
             params=filter(lambda p: p.requires_grad, self.my_model.classifier.parameters()),
             lr=args.LR_classifier, weight_decay=args.L2)
 
-    def get_corpus_to_examples(self, dataset):
-        corpus_to_example = {}
-
-        for example in dataset:
-            corpus_name = self.ID_to_corpus_dic[str(int(example.ID))[:5]]
-            corpus_to_example.setdefault(corpus_name, [])
-            corpus_to_example[corpus_name].append(example)
-
-        return corpus_to_example
-
-    def save_model(self, epoch):
-        self.model_state_dic['epoch'] = epoch
-        self.model_state_dic['my_model'] = self.my_model.state_dict()
-        torch.save(self.model_state_dic, file_model_save)
+    def get_corpus_to_indices(self, dataset):
+        corpus_to_indices = {}
+
+        for index, ID in enumerate(dataset.ID.tolist()):
+            corpus_name = self.ID_to_corpus_dic[str(ID)[:5]]
+            corpus_to_indices.setdefault(corpus_name, [])
+            corpus_to_indices[corpus_name].append(index)
+
+        for corpus_name, indices in corpus_to_indices.items():
+            corpus_to_indices[corpus_name] = np.array(indices, dtype=np.int64)
+            corpus_to_indices[corpus_name].flags.writeable = False
+        return corpus_to_indices
+
+    def get_example_corpus_index(self, dataset, corpus_to_indices_dic):
+        example_corpus_index = np.zeros(len(dataset), dtype=np.int64)
+        for corpus_index, corpus_name in enumerate(args.Corpus_list):
+            example_corpus_index[corpus_to_indices_dic.get(corpus_name, np.empty(0, dtype=np.int64))] = corpus_index
+        return example_corpus_index
+
+    def get_corpus_index_list(self, corpus_list):
+        return [args.Corpus_list.index(corpus_name) for corpus_name in corpus_list]
+
+    def save_model(self, epoch, my_model_state_dic=None):
+        # my_model_state_dic: CPU snapshot of the weights of the epoch, the current weights when it is None.
+        # the checkpoint is written in the background, training never waits for the disk
+        if my_model_state_dic is None:
+            my_model_state_dic = get_cpu_state_dic(self.my_model)
+        self.checkpoint_writer.save({'epoch': epoch, 'my_model': my_model_state_dic}, file_model_save)
+
+    def backward_step(self, batch_loss):
+        with sync_counter.stage("backward"):
+            batch_loss.backward()
+
+            self.optimizer_encoder.step()
+            self.optimizer_encoder.zero_grad()
+
+            self.optimizer_classifier.step()
+            self.optimizer_classifier.zero_grad()
+
+    def get_training_state(self):
+        # CPU snapshot of everything the next epochs depend on, to go back to this epoch
+        return {"my_model": get_cpu_state_dic(self.my_model),
+                "optimizer_encoder": get_cpu_copy(self.optimizer_encoder.state_dict()),
+                "optimizer_classifier": get_cpu_copy(self.optimizer_classifier.state_dict()),
+                "random_state": (random.getstate(), np.random.get_state(), torch.get_rng_state(),
+                                 torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None)}
+
+    def load_training_state(self, training_state_dic):
+        self.my_model.load_state_dict(training_state_dic["my_model"])
+        self.optimizer_encoder.load_state_dict(training_state_dic["optimizer_encoder"])
+        self.optimizer_classifier.load_state_dict(training_state_dic["optimizer_classifier"])
+        python_state, numpy_state, torch_state, cuda_state_list = training_state_dic["random_state"]
+        random.setstate(python_state)
+        np.random.set_state(numpy_state)
+        torch.set_rng_state(torch_state)
+        if cuda_state_list is not None:
+            torch.cuda.set_rng_state_all(cuda_state_list)
 
     def one_epoch(self, corpus_list, batch_iterator, valid_test_flag):
-        dic_batches_res = {"ID": [], "relation": []}
-        epoch_loss = 0
-        count = 0
+        # one pass over the corpora of corpus_list, the metrics are kept per corpus
+        relation_counter = StreamingRelationCounter(self.relation_list, self.example_corpus_index_dic[valid_test_flag],
+                                                    len(args.Corpus_list))
 
         if valid_test_flag == "train":
-            total_examples = 0
-            for batch in batch_iterator:
-                total_examples += len(batch)
-            print(f"Corpus {corpus_list}, Total examples {total_examples}")
+            print(f"Corpus {corpus_list}, Total examples {len(batch_iterator.dataset)}")
 
         for batch in batch_iterator:
-            count += 1
-
-            # D_replay
-            if valid_test_flag == "train" and corpus_list[0] != args.Corpus_list[0]:
+            replay_flag = valid_test_flag == "train" and corpus_list[0] != args.Corpus_list[0]
+            if replay_flag and args.Replay_mode == "fused":
+                # D_replay and D_train in one mixed batch, one forward, backward and optimizer step
                 replay_batch = self.get_batch_memory()
+                mixed_batch = self.train_dataset.collator.concat([replay_batch, batch])
                 with torch.cuda.amp.autocast():
-                    batch_loss, _ = self.my_model.forward(replay_batch)
+                    batch_source_loss, batch_relation_TP_FN_FP = self.my_model.forward(
+                        mixed_batch, source_lens=[len(replay_batch), len(batch)])
 
-                batch_loss = 0.3 * batch_loss
+                relation_counter.update(batch_relation_TP_FN_FP[len(replay_batch):], batch_source_loss[1], batch.index)
 
-                batch_loss.backward()
+                self.backward_step(args.Replay_loss_weight * batch_source_loss[0] +
+                                   args.Train_loss_weight * batch_source_loss[1])
+                continue
 
-                self.optimizer_encoder.step()
-                self.optimizer_encoder.zero_grad()
+            # D_replay
+            if replay_flag:
+                replay_batch = self.get_batch_memory()
+                with torch.cuda.amp.autocast():
+                    batch_loss, _ = self.my_model.forward(replay_batch)
 
-                self.optimizer_classifier.step()
-                self.optimizer_classifier.zero_grad()
+                self.backward_step(args.Replay_loss_weight * batch_loss)
 
             # D_train
             with torch.cuda.amp.autocast():
-                batch_loss, batch_res = self.my_model.forward(batch)
+                batch_loss, batch_relation_TP_FN_FP = self.my_model.forward(batch)
 
-            epoch_loss += batch_loss
+            relation_counter.update(batch_relation_TP_FN_FP, batch_loss, batch.index)
 
             if valid_test_flag == "train":
-                batch_loss = 0.3 * batch_loss
-
-                batch_loss.backward()
+                self.backward_step(args.Train_loss_weight * batch_loss)
 
-                self.optimizer_encoder.step()
-                self.optimizer_encoder.zero_grad()
-
-                self.optimizer_classifier.step()
-                self.optimizer_classifier.zero_grad()
-
-            dic_batches_res["ID"].append(batch.ID)
-            dic_batches_res["relation"].append(batch_res)
+        if valid_test_flag == "train":
+            token_padding_ratio, pair_padding_ratio = batch_iterator.batch_sampler.padding_ratio()
+            print(f"Padding ratio, tokens: {token_padding_ratio:.3f}, entity pairs: {pair_padding_ratio:.3f}")
 
-        dic_loss = {"relation": epoch_loss, "average": epoch_loss / count}
+        sync_counter.report(f"{valid_test_flag} {corpus_list}")
+        print(f"Sentences without entity pair, not encoded: {self.my_model.encoder.skipped_sequence_num}")
+        self.my_model.encoder.skipped_sequence_num = 0
 
-        return dic_loss, dic_batches_res
+        return relation_counter.get_dic_loss(), relation_counter
 
     def one_epoch_train(self, corpus_list):
         self.my_model.train()
-        dic_loss, dic_batches_res = self.one_epoch(corpus_list, self.train_iterator, "train")
-        return dic_loss, dic_batches_res
+        dic_loss, relation_counter = self.one_epoch(corpus_list,
+                                                    self.get_iterator_for_corpus_list("train", corpus_list), "train")
+        return dic_loss, relation_counter
 
     def one_epoch_valid(self, corpus_list):
         with torch.no_grad():
             self.my_model.eval()
-            dic_loss, dic_batches_res = self.one_epoch(corpus_list, self.valid_iterator, "valid")
-        return dic_loss, dic_batches_res
-
-    def set_iterator_for_corpus_list(self, corpus_list):
-        self.train_dataset.examples = []
-        self.valid_dataset.examples = []
-        self.test_dataset.examples = []
-
-        for corpus in corpus_list:
-            self.train_dataset.examples += self.train_corpus_to_examples_dic[corpus]
-            self.valid_dataset.examples += self.valid_corpus_to_examples_dic[corpus]
-            self.test_dataset.examples += self.test_corpus_to_examples_dic[corpus]
-
-        train_iterator, valid_iterator, test_iterator = torchtext.legacy.data.BucketIterator.splits(
-            [self.train_dataset, self.valid_dataset, self.test_dataset],
-            batch_size=args.BATCH_SIZE, sort=False, shuffle=True, repeat=False, device=device)
-        self.train_iterator = train_iterator
-        self.valid_iterator = valid_iterator
-        self.test_iterator = test_iterator
+            dic_loss, relation_counter = self.one_epoch(corpus_list,
+                                                        self.get_iterator_for_corpus_list("valid", corpus_list),
+                                                        "valid")
+        return dic_loss, relation_counter
 
-    def get_batch_memory(self):
-        batch_ids = random.sample(self.total_memorized_samples, k=args.BATCH_SIZE)
-        batch_examples = []
-        for corpus_name, _ in self.memorized_samples.items():
-            for example in self.train_corpus_to_examples_dic[corpus_name]:
-                if int(example.ID) in batch_ids:
-                    batch_examples.append(example)
+    def one_epoch_test(self, corpus_list):
+        with torch.no_grad():
+            self.my_model.eval()
+            dic_loss, relation_counter = self.one_epoch(corpus_list,
+                                                        self.get_iterator_for_corpus_list("test", corpus_list), "test")
+        return dic_loss, relation_counter
+
+    def get_iterator(self, dataset, indices, shuffle, batch_device=device, num_workers=args.NUM_WORKERS):
+        sequence_lengths = dataset.get_sequence_lengths(args.Entity_Prep_Way == "entity_type_marker")
+        batch_sampler = BucketBatchSampler(sequence_lengths[indices], dataset.entity_pair_nums[indices],
+                                           args.BATCH_SIZE, shuffle=shuffle, bucket=args.Batch_way == "bucket",
+                                           max_tokens=args.MAX_TOKENS, max_pairs=args.MAX_PAIRS)
+        return BatchIterator(torch.utils.data.Subset(dataset, indices), dataset.collator, batch_sampler,
+                             batch_device, num_workers=num_workers, prefetch_factor=args.PREFETCH_FACTOR)
+
+    def get_indices_for_corpus_list(self, corpus_to_indices_dic, corpus_list):
+        indices = np.concatenate([corpus_to_indices_dic.get(corpus, np.empty(0, dtype=np.int64))
+                                  for corpus in corpus_list])
+        indices.flags.writeable = False
+        return indices
+
+    def get_iterator_for_corpus_list(self, split, corpus_list):
+        # the iterators are cached, switching corpora neither copies examples nor rebuilds iterators
+        key = (split, tuple(corpus_list))
+        if key not in self.iterator_cache_dic:
+            indices = self.get_indices_for_corpus_list(self.corpus_to_indices_dic[split], corpus_list)
+            self.iterator_cache_dic[key] = self.get_iterator(self.dataset_dic[split], indices,
+                                                             shuffle=split == "train")
+        return self.iterator_cache_dic[key]
+
+    def clear_iterator_cache(self):
+        # the iterators of a finished task are not used again, dropping them shuts down their persistent workers
+        self.iterator_cache_dic = {}
+
+    def valid_worker_loop(self, valid_model, job_queue, result_queue):
+        # runs in the forked process of BackgroundValidator, on the CPU only
+        sync_counter.enabled = False
+        if args.Valid_threads:
+            torch.set_num_threads(args.Valid_threads)
+        cpu_device = torch.device("cpu")
+        valid_model.eval()
+        iterator_dic = {}
+        while True:
+            job = job_queue.get()
+            if job is None:
+                break
+            epoch, valid_corpus_list, my_model_state_dic = job
+            valid_model.load_state_dict(my_model_state_dic)
+            del my_model_state_dic
+
+            if tuple(valid_corpus_list) not in iterator_dic:
+                indices = self.get_indices_for_corpus_list(self.corpus_to_indices_dic["valid"], valid_corpus_list)
+                iterator_dic[tuple(valid_corpus_list)] = self.get_iterator(self.dataset_dic["valid"], indices, False,
+                                                                           batch_device=cpu_device, num_workers=0)
+            relation_counter = StreamingRelationCounter(self.relation_list, self.example_corpus_index_dic["valid"],
+                                                        len(args.Corpus_list))
+            with torch.no_grad():
+                for batch in iterator_dic[tuple(valid_corpus_list)]:
+                    batch_loss, batch_relation_TP_FN_FP = valid_model.forward(batch)
+                    relation_counter.update(batch_relation_TP_FN_FP, batch_loss, batch.index)
+
+            result_queue.put((epoch, relation_counter.get_dic_loss(),
+                              [relation_counter.get_relation_TP_FN_FP(self.get_corpus_index_list([corpus_name]))
+                               for corpus_name in valid_corpus_list]))
+
+    def select_epoch(self, corpus_name, epoch, valid_corpus_list, dic_valid_loss, valid_relation_TP_FN_FP_list,
+                     selection_dic, my_model_state_dic=None):
+        # reports the validation of an epoch and saves it when it is the best of the current corpus (the last one of
+        # valid_corpus_list), returns True on early stop
+        for corpus_name_valid, valid_relation_TP_FN_FP in zip(valid_corpus_list, valid_relation_TP_FN_FP_list):
+            micro_P_R_F1, relation_P_R_F1, relation_TP_FN_FP = report_performance(corpus_name_valid, epoch,
+                                                                                  dic_valid_loss,
+                                                                                  valid_relation_TP_FN_FP,
+                                                                                  "valid")
+
+        if micro_P_R_F1[2] >= selection_dic["maxF"]:
+            selection_dic["early_stop_num"] = args.EARLY_STOP_NUM
+            selection_dic["maxF"] = micro_P_R_F1[2]
+            selection_dic["save_epoch"] = epoch
+            self.save_model(epoch, my_model_state_dic)
+            file_detail_performance = f'result/detail_performance/continual_{str(args.ID)}/performance_{corpus_name}.txt'
+            os.makedirs(os.path.dirname(file_detail_performance), exist_ok=True)
+            record_detail_performance(relation_P_R_F1, micro_P_R_F1, file_detail_performance,
+                                      relation_TP_FN_FP, self.corpus_information, [corpus_name])
+        else:
+            selection_dic["early_stop_num"] -= 1
+
+        if selection_dic["early_stop_num"] <= 0:
+            print("Early stop, in epoch: %d !" % (int(selection_dic["save_epoch"])))
+            print("Max micro-F1: %s " % (str(selection_dic["maxF"])))
+            return True
+        return False
+
+    def collect_background_valid(self, corpus_name, valid_corpus_list, selection_dic, max_pending_num):
+        # the results are handled in epoch order, exactly like a synchronous validation, until at most
+        # max_pending_num epochs are pending. On early stop, the later epochs are dropped and the training goes back
+        # to the early stopped epoch, where a synchronous validation would have stopped it
+        while len(self.background_validator) > max_pending_num:
+            epoch, training_state_dic, dic_valid_loss, valid_relation_TP_FN_FP_list = \
+                self.background_validator.get_result()
+            if self.select_epoch(corpus_name, epoch, valid_corpus_list, dic_valid_loss, valid_relation_TP_FN_FP_list,
+                                 selection_dic, training_state_dic["my_model"]):
+                self.background_validator.discard_pending()
+                self.load_training_state(training_state_dic)
+                return True
+        return False
 
-        batch = Batch(data=batch_examples, dataset=self.train_dataset, device=device)
-        return batch
+    def get_batch_memory(self):
+        return self.replay_buffer.get_batch()
 
     @print_execute_time
     def train_valid_fn(self):
+        if args.Replay_mode not in ["sequential", "fused"]:
+            raise Exception("Choose replay mode error !")
         corpus_list = copy.deepcopy(args.Corpus_list)
         print("start training...")
+        if args.Async_valid:
+            self.background_validator = BackgroundValidator(self)
         for idx_corpus, corpus_name in enumerate(corpus_list):
             print('*' * 50)
             print(f"==================== Training {corpus_name} ====================")
-            maxF = 0
-            save_epoch = 0
-            early_stop_num = args.EARLY_STOP_NUM
-            self.set_iterator_for_corpus_list([corpus_name])
+            selection_dic = {"maxF": 0, "save_epoch": 0, "early_stop_num": args.EARLY_STOP_NUM}
+            # the current and all previous corpora are validated in one pass
+            valid_corpus_list = corpus_list[:idx_corpus + 1]
+            early_stop_flag = False
             for epoch in range(0, args.EPOCH):
-                dic_train_loss, dic_batches_train_res = self.one_epoch_train([corpus_name])
+                if self.background_validator is not None:
+                    # the training does not run more than Valid_max_lag epochs ahead of the validation
+                    early_stop_flag = self.collect_background_valid(corpus_name, valid_corpus_list, selection_dic,
+                                                                    args.Valid_max_lag)
+                    if early_stop_flag:
+                        break
+
+                dic_train_loss, train_relation_counter = self.one_epoch_train([corpus_name])
                 if epoch >= args.MIN_EPOCH_VALID:
                     report_performance(corpus_name, epoch, dic_train_loss,
-                                       dic_batches_train_res,
-                                       self.relation_list,
+                                       train_relation_counter.get_relation_TP_FN_FP(),
                                        "train")
 
-                    # Validating for each previous corpus
-                    for i in range(0, idx_corpus + 1):
-                        corpus_name_valid = corpus_list[i]
-                        self.set_iterator_for_corpus_list([corpus_name_valid])
-                        dic_valid_loss, dic_batches_valid_res = self.one_epoch_valid(corpus_name_valid)
-                        micro_P_R_F1, relation_P_R_F1, relation_TP_FN_FP = report_performance(corpus_name_valid, epoch,
-                                                                                              dic_valid_loss,
-                                                                                              dic_batches_valid_res,
-                                                                                              self.relation_list,
-                                                                                              "valid")
-
-                    if micro_P_R_F1[2] >= maxF:
-                        early_stop_num = args.EARLY_STOP_NUM
-                        maxF = micro_P_R_F1[2]
-                        save_epoch = epoch
-                        self.save_model(save_epoch)
-                        file_detail_performance = f'result/detail_performance/continual_{str(args.ID)}/performance_{corpus_name}.txt'
-                        os.makedirs(os.path.dirname(file_detail_performance), exist_ok=True)
-                        record_detail_performance(relation_P_R_F1, micro_P_R_F1, file_detail_performance,
-                                                  relation_TP_FN_FP, self.corpus_information, [corpus_name])
-                    else:
-                        early_stop_num -= 1
-
-                    if early_stop_num <= 0:
-                        print("Early stop, in epoch: %d !" % (int(save_epoch)))
-                        print("Max micro-F1: %s " % (str(maxF)))
+                    # Validating for each previous corpus, the current one is the last
+                    if self.background_validator is not None:
+                        self.background_validator.submit(epoch, valid_corpus_list, self.get_training_state())
+                        continue
+
+                    dic_valid_loss, valid_relation_counter = self.one_epoch_valid(valid_corpus_list)
+                    valid_relation_TP_FN_FP_list = [
+                        valid_relation_counter.get_relation_TP_FN_FP(self.get_corpus_index_list([corpus_name_valid]))
+                        for corpus_name_valid in valid_corpus_list]
+                    if self.select_epoch(corpus_name, epoch, valid_corpus_list, dic_valid_loss,
+                                         valid_relation_TP_FN_FP_list, selection_dic):
                         break
                 else:
                     print("Epoch: ", epoch)
+            if self.background_validator is not None and not early_stop_flag:
+                self.collect_background_valid(corpus_name, valid_corpus_list, selection_dic, 0)
             print()
-            print("Reach max epoch: %d !" % (int(save_epoch)))
-            print("Max micro-F1: %s " % (str(maxF)))
+            print("Reach max epoch: %d !" % (int(selection_dic["save_epoch"])))
+            print("Max micro-F1: %s " % (str(selection_dic["maxF"])))
             # shutil.copy(file_model_save, file_model_save + "_" + corpus_name)
             print(f"==================== Create memorized samples for {corpus_name} ====================")
-            self.set_iterator_for_corpus_list([corpus_name])
             all_embedding_representations = []
-            for batch in self.train_iterator:
+            for batch in self.get_iterator_for_corpus_list("train", [corpus_name]):
                 # Step 1
-                batch_entity, batch_entity_type = self.my_model.get_relation_data(batch)
+                batch_entity = self.my_model.get_relation_data(batch)
 
                 # Step 2
                 batch_RE_gold_res_list = []
-                for sent_index in range(len(batch)):
-                    gold_one_sent_all_sub_task_res_dic = []
-                    for relation in self.my_model.classifier.relation_list:
-                        for entity_pair in getattr(batch, relation)[sent_index]:
-                            entity_pair_span = self.my_model.classifier.TAGS_Types_fields_dic[relation][1].vocab.itos[entity_pair]
-                            if entity_pair_span != "[PAD]":
-                                temp_pair = sorted(eval(entity_pair_span))
-                                if temp_pair not in gold_one_sent_all_sub_task_res_dic:
-                                    gold_one_sent_all_sub_task_res_dic.append(temp_pair)
-
-                    batch_RE_gold_res_list.append(gold_one_sent_all_sub_task_res_dic)
+                for gold_one_sent_all_sub_task_res_dic in self.my_model.get_gold_relation(batch):
+                    gold_one_sent_pair_list = []
+                    for relation_entity_pair_list in gold_one_sent_all_sub_task_res_dic.values():
+                        for entity_pair in relation_entity_pair_list:
+                            if entity_pair not in gold_one_sent_pair_list:
+                                gold_one_sent_pair_list.append(entity_pair)
+                    batch_RE_gold_res_list.append(gold_one_sent_pair_list)
 
                 # Step 3
                 with torch.no_grad():
                     batch_added_marker_entity_span_vec, batch_entity_pair_span_list, batch_sent_len_list = \
                         self.my_model.encoder.memory_get_entity_pair_rep(batch_entity=batch_entity,
-                                                                         batch_tokens=batch.tokens,
-                                                                         batch_entity_type=batch_entity_type,
+                                                                         batch_marked_tokens=batch.marked_tokens,
+                                                                         batch_marked_entity_spans=batch.marked_entity_spans,
                                                                          batch_gold_RE=batch_RE_gold_res_list)
                 # Step 4
                 for sent_index in range(len(batch)):
@@ -327,17 +575,25 @@ class TrainValidTest:
                         all_embedding_representations.append((embed, ID_example))
 
             self.memorized_samples[corpus_name] = select_data(all_embedding_representations)
-            self.total_memorized_samples += self.memorized_samples[corpus_name]
+            self.replay_buffer.add_corpus(corpus_name, self.memorized_samples[corpus_name])
             print(f"Number representation: ", len(all_embedding_representations))
             print(f"Number examples in memorized samples {corpus_name}: ", len(self.memorized_samples[corpus_name]))
             pickle.dump(self.memorized_samples, open(file_memory_save, "wb"))
             # ======================== Testing ========================
             self.test_fn(idx_corpus, file_model_save)
+            self.clear_iterator_cache()
+
+        if self.background_validator is not None:
+            self.background_validator.close()
+            self.background_validator = None
+        self.checkpoint_writer.flush()
 
     def test_fn(self, idx_corpus, file_model_save_path):
         print("==================== Testing ====================")
         print(file_model_save_path)
         print("Loading model...")
+        # the checkpoints still being written are on the disk first
+        self.checkpoint_writer.flush()
         checkpoint = torch.load(file_model_save_path, map_location=device)
         self.my_model.load_state_dict(checkpoint['my_model'])
         print("Loading success !")
@@ -350,29 +606,13 @@ class TrainValidTest:
             corpus_list.append([corpus_name])
         corpus_list.append([corpus_name for corpus_name in current_corpus_list])
 
-        for corpus_name in corpus_list:
-            self.set_iterator_for_corpus_list(corpus_name)
-            with torch.no_grad():
-                self.my_model.eval()
-                dic_batches_res = {"ID": [], "relation": []}
-                epoch_loss = 0
-                count = 0
-
-                for batch in self.test_iterator:
-                    count += 1
-                    with torch.cuda.amp.autocast():
-                        batch_loss, batch_res = self.my_model.forward(batch)
-
-                    epoch_loss += batch_loss
-
-                    dic_batches_res["ID"].append(batch.ID)
-                    dic_batches_res["relation"].append(batch_res)
-
-                dic_loss = {"average": epoch_loss / count, "relation": epoch_loss}
+        # one pass over all the corpora, each single corpus and their union are read from the same counter
+        dic_loss, relation_counter = self.one_epoch_test(current_corpus_list)
 
+        for corpus_name in corpus_list:
+            test_relation_TP_FN_FP = relation_counter.get_relation_TP_FN_FP(self.get_corpus_index_list(corpus_name))
             micro_P_R_F1, relation_P_R_F1, relation_TP_FN_FP = report_performance(corpus_name, 0, dic_loss,
-                                                                                  dic_batches_res,
-                                                                                  self.relation_list,
+                                                                                  test_relation_TP_FN_FP,
                                                                                   "test")
 
             file_detail_performance = f'result/detail_performance/continual_{str(args.ID)}/{idx_corpus}/performance_{str(corpus_name)}.txt'
@@ -408,12 +648,12 @@ def get_valid_performance(model_path):
 
     my_model = MyModel(my_bert_encoder, my_relation_classifier, args, device)
 
-    train_dataset, valid_dataset, test_dataset, TAGS_Entity_Type_fields_dic, TAGS_Relation_fields_dic, TAGS_sep_entity_fields_dic \
-        = prepared_data(tokenizer, combining_data_files_list, entity_type_list, relation_list)
+    relation_signature_dic = get_relation_signature_dic(corpus_information) if args.Pair_type_filter else None
+    train_dataset, valid_dataset, test_dataset = prepared_data(tokenizer, combining_data_files_list,
+                                                               entity_type_list, relation_list,
+                                                               relation_signature_dic, args.Max_pair_distance)
 
-    my_relation_classifier.create_classifiers(TAGS_Relation_fields_dic,
-                                              TAGS_sep_entity_fields_dic,
-                                              TAGS_Entity_Type_fields_dic)
+    my_relation_classifier.create_classifiers(relation_list, entity_type_list)
 
     my_train_valid_test = TrainValidTest(ID_to_corpus_dic, my_model,
                                          train_dataset, valid_dataset, test_dataset,
@@ -429,14 +669,31 @@ if __name__ == "__main__":
     print("GPU:", args.GPU)
     print("Bert:", args.BERT_MODEL)
     print("Batch size: ", args.BATCH_SIZE)
+    print("Num workers: ", args.NUM_WORKERS)
+    print("Batch_way: ", args.Batch_way)
+    print("MAX_TOKENS: ", args.MAX_TOKENS)
+    print("MAX_PAIRS: ", args.MAX_PAIRS)
     print("Memory size: ", args.MEMORY_SIZE)
+    print("Replay_balanced:", args.Replay_balanced)
+    print("Replay_prebuilt_batches:", args.Replay_prebuilt_batches)
+    print("Replay_mode:", args.Replay_mode)
+    print("Replay_loss_weight:", args.Replay_loss_weight)
+    print("Train_loss_weight:", args.Train_loss_weight)
     print("LR_bert: ", args.LR_bert)
     print("LR_classifier: ", args.LR_classifier)
     print("ALL_DATA:", args.ALL_DATA)
     print("Corpus_list:", args.Corpus_list)
     print("Entity_Prep_Way:", args.Entity_Prep_Way)
     print("Loss:", args.Loss)
+    print("Fused_head:", args.Fused_head)
+    print("Packed_pairs:", args.Packed_pairs)
+    print("Pair_type_filter:", args.Pair_type_filter)
+    print("Max_pair_distance:", args.Max_pair_distance)
     print("EARLY_STOP_NUM:", args.EARLY_STOP_NUM)
     print("Only_test:", args.Only_test)
+    print("Async_valid:", args.Async_valid)
+    print("Valid_max_lag:", args.Valid_max_lag)
+    print("Valid_threads:", args.Valid_threads)
+    print("Sync_debug:", args.Sync_debug)
 
     get_valid_performance(args.bert_model_path)
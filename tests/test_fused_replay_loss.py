@@ -0,0 +1,77 @@
+import json
+import os
+import sys
+import types
+
+import pytest
+import torch
+import transformers
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_cache import load_model_data
+from data_loader import ModelBatchCollator, ModelDataset
+from model.my_classifier import MyRelationClassifier
+from model.my_encoder import MyEncoder
+from model.my_model import MyModel
+
+ENTITY_TYPE_LIST = ["Drug", "Effect"]
+RELATION_LIST = ["Adverse_Effect", "Drug_Drug_interaction"]
+
+# replay-like examples with few entities, then current-task examples with many, so the two sources have different
+# numbers of pairs
+EXAMPLE_LIST = [
+    {"ID": "44444000", "tokens": [1, 5, 6, 7, 8, 2], "sep_entity": ["[1]", "[3, 4]"], "Drug": ["[1]"],
+     "Effect": ["[3, 4]"], "Adverse_Effect": ["([1], [3, 4])"]},
+    {"ID": "44444001", "tokens": [1, 9, 10, 2], "sep_entity": ["[1]", "[2]"], "Drug": ["[1]"], "Effect": ["[2]"]},
+    {"ID": "22222000", "tokens": [1, 5, 6, 7, 8, 9, 10, 11, 12, 2],
+     "sep_entity": ["[1]", "[3]", "[5, 6]", "[8]"], "Drug": ["[1]", "[3]", "[5, 6]", "[8]"],
+     "Drug_Drug_interaction": ["([1], [5, 6])", "([3], [8])"]},
+    {"ID": "22222001", "tokens": [1, 13, 14, 15, 16, 17, 2], "sep_entity": ["[1]", "[2]", "[4]", "[5]", "[6]"],
+     "Drug": ["[1]", "[2]", "[4]", "[5]", "[6]"], "Drug_Drug_interaction": ["([2], [6])"]},
+]
+
+
+def build_model_and_dataset(tmp_path, entity_prep_way, loss, packed_pairs):
+    json_file = tmp_path / "train_model_data.json"
+    with open(json_file, "w") as f:
+        for example in EXAMPLE_LIST:
+            f.write(json.dumps(example) + "\n")
+    collator = ModelBatchCollator(pad_token_id=0)
+    # marker ids of Drug, Effect and untyped entities
+    dataset = ModelDataset(load_model_data(str(json_file), ENTITY_TYPE_LIST, RELATION_LIST), collator,
+                           [20, 21, 22], [23, 24, 25])
+
+    args = types.SimpleNamespace(Word_embedding_size=32, Hidden_Size_Common_Encoder=32,
+                                 Entity_Prep_Way=entity_prep_way, Loss=loss, Weight_Loss=True, Min_weight=0.5,
+                                 Max_weight=5, BATCH_SIZE=8, Fused_head=False, Packed_pairs=packed_pairs)
+    torch.manual_seed(0)
+    bert = transformers.BertModel(transformers.BertConfig(vocab_size=32, hidden_size=32, num_hidden_layers=1,
+                                                          num_attention_heads=2, intermediate_size=64,
+                                                          max_position_embeddings=64))
+    device = torch.device("cpu")
+    encoder = MyEncoder(bert, types.SimpleNamespace(vocab={"[PAD]": 0}), args, device)
+    classifier = MyRelationClassifier(args, device)
+    my_model = MyModel(encoder, classifier, args, device)
+    classifier.create_classifiers(RELATION_LIST, ENTITY_TYPE_LIST)
+    my_model.eval()
+    return my_model, dataset
+
+
+@pytest.mark.parametrize("packed_pairs", [False, True])
+@pytest.mark.parametrize("loss", ["BCE", "CE"])
+@pytest.mark.parametrize("entity_prep_way", ["entity_type_marker", "standard"])
+def test_source_loss_equals_separate_forward(tmp_path, entity_prep_way, loss, packed_pairs):
+    my_model, dataset = build_model_and_dataset(tmp_path, entity_prep_way, loss, packed_pairs)
+    replay_batch = dataset.collator([dataset[0], dataset[1]])
+    batch = dataset.collator([dataset[2], dataset[3]])
+    mixed_batch = dataset.collator.concat([replay_batch, batch])
+
+    with torch.no_grad():
+        replay_loss, _ = my_model(replay_batch)
+        batch_loss, _ = my_model(batch)
+        batch_source_loss, _ = my_model(mixed_batch, source_lens=[len(replay_batch), len(batch)])
+
+    assert batch_source_loss.shape == (2,)
+    assert torch.allclose(batch_source_loss[0], replay_loss, atol=1e-5)
+    assert torch.allclose(batch_source_loss[1], batch_loss, atol=1e-5)
@@ -0,0 +1,54 @@
+import json
+import os
+import sys
+import types
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_cache import load_model_data
+from data_loader import ModelBatchCollator, ModelDataset, get_allowed_type_pair_matrix
+from model.my_classifier import MyRelationClassifier
+
+ENTITY_TYPE_LIST = ["Drug", "Protein"]
+RELATION_LIST = ["Chemical_Protein_interaction", "Drug_Drug_interaction"]
+RELATION_SIGNATURE_DIC = {"Chemical_Protein_interaction": [["Drug", "Protein"]],
+                          "Drug_Drug_interaction": [["Drug", "Drug"]]}
+
+# pairs (Drug, Drug), (Drug, Protein), (Drug, Protein), a gold Drug_Drug_interaction on the first one
+EXAMPLE = {"ID": "11111000", "tokens": [1, 5, 6, 7, 8, 9, 2], "sep_entity": ["[1]", "[3]", "[5]"],
+           "Drug": ["[1]", "[3]"], "Protein": ["[5]"], "Drug_Drug_interaction": ["([1], [3])"]}
+
+
+def test_disallowed_relations_are_labelled(tmp_path):
+    json_file = tmp_path / "train_model_data.json"
+    json_file.write_text(json.dumps(EXAMPLE) + "\n")
+    allowed_type_pair_matrix = get_allowed_type_pair_matrix(ENTITY_TYPE_LIST, RELATION_LIST, RELATION_SIGNATURE_DIC)
+    dataset = ModelDataset(load_model_data(str(json_file), ENTITY_TYPE_LIST, RELATION_LIST),
+                           ModelBatchCollator(pad_token_id=0), [20, 21, 22], [23, 24, 25], allowed_type_pair_matrix)
+
+    # each relation is only allowed on the pairs of its own signature
+    assert dataset.relation_labels.tolist() == [[3, 1], [0, 3], [0, 3]]
+    assert dataset.gold_relation_nums.tolist() == [[0, 1]]
+
+
+def test_disallowed_relations_are_predicted_no():
+    args = types.SimpleNamespace(Entity_Prep_Way="entity_type_marker", Word_embedding_size=8, Weight_Loss=False,
+                                 Fused_head=False, Loss="BCE")
+    classifier = MyRelationClassifier(args, torch.device("cpu"))
+    classifier.create_classifiers(RELATION_LIST, ENTITY_TYPE_LIST)
+    torch.manual_seed(0)
+    pair_vec = torch.randn(4, 6, 8)
+    relation_allowed_mask = torch.from_numpy(np.random.RandomState(0).rand(2, 4, 6) > 0.5)
+
+    pred_type_tensor, batch_pred_logits = classifier(pair_vec, relation_allowed_mask)
+    for relation_index in range(len(RELATION_LIST)):
+        assert not (pred_type_tensor[~relation_allowed_mask[relation_index]] == relation_index).any()
+
+    # the not allowed cells are not in the loss, whatever their logits
+    gold = torch.zeros(2, 4, 6, dtype=torch.long).masked_fill(~relation_allowed_mask, classifier.not_allowed_index)
+    for loss_fn in [classifier.BCE_loss, classifier.get_ensembled_ce_loss]:
+        changed_logits = batch_pred_logits.masked_fill(~relation_allowed_mask.unsqueeze(-1), 100.)
+        assert torch.allclose(loss_fn(batch_pred_logits, gold), loss_fn(changed_logits, gold))
@@ -1,4 +1,10 @@
+import os
 import sys
+import threading
+import uuid
+import warnings
+from contextlib import contextmanager
+import torch
 
 
 def print_execute_time(func):
@@ -28,12 +34,121 @@ def print_execute_time(func):
     return wrapper
 
 
-def get_sent_len(one_sent_tags, TAGS_field):
-    sentence_length = 0
-    for tags in one_sent_tags:
-        if int(tags) != TAGS_field.vocab["[PAD]"]:
-            sentence_length += 1
-    return sentence_length
+@contextmanager
+def atomic_open(filename, mode="w"):
+    # write into a temporary file in the same folder, then rename it, readers never see a partial file
+    dir_name = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(dir_name, exist_ok=True)
+    # created like open() would create the file, with the permissions given by the umask (mkstemp would make it
+    # readable by the owner only)
+    temp_file = os.path.join(dir_name, ".tmp_" + uuid.uuid4().hex)
+    fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, mode, **({} if "b" in mode else {"encoding": "utf-8"})) as f:
+            yield f
+        os.replace(temp_file, filename)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+
+class AsyncCheckpointWriter(object):
+    # torch.save in a background thread, the caller hands over a checkpoint already copied to the CPU and goes on.
+    # every file is written with atomic_open, and a checkpoint still waiting for the disk is replaced by a newer one
+    # of the same file, so only the latest one is written
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending_dic = {}
+        self.writing = False
+        self.error = None
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def save(self, checkpoint, filename):
+        with self.condition:
+            self.raise_error()
+            self.pending_dic.pop(filename, None)
+            self.pending_dic[filename] = checkpoint
+            self.condition.notify_all()
+
+    def write_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending_dic:
+                    self.condition.wait()
+                filename = next(iter(self.pending_dic))
+                checkpoint = self.pending_dic.pop(filename)
+                self.writing = True
+            try:
+                with atomic_open(filename, "wb") as f:
+                    torch.save(checkpoint, f)
+            except Exception as error:
+                self.error = error
+            finally:
+                del checkpoint
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
+
+    def flush(self):
+        # returns once every checkpoint handed over is on the disk
+        with self.condition:
+            while self.pending_dic or self.writing:
+                self.condition.wait()
+            self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+class DeviceSyncCounter(object):
+    # counts the synchronizing device-to-host transfers (.item(), .tolist(), bool(tensor) ...) of each stage with
+    # torch.cuda.set_sync_debug_mode, only works on cuda with torch >= 1.10, stages must not be nested
+    def __init__(self):
+        self.enabled = False
+        self.stage_count_dic = {}
+
+    def enable(self, device):
+        self.enabled = torch.cuda.is_available() and str(device).startswith("cuda")
+        if not self.enabled:
+            print("Device sync debug needs a cuda device, disabled.")
+        elif not hasattr(torch.cuda, "set_sync_debug_mode"):
+            self.enabled = False
+            print("Device sync debug needs torch 1.10 or later, disabled.")
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        with warnings.catch_warnings(record=True) as warning_list:
+            warnings.simplefilter("always")
+            torch.cuda.set_sync_debug_mode("warn")
+            try:
+                yield
+            finally:
+                torch.cuda.set_sync_debug_mode("default")
+
+        count = 0
+        for warning in warning_list:
+            if "synchroniz" in str(warning.message):
+                count += 1
+            else:
+                warnings.warn_explicit(warning.message, warning.category, warning.filename, warning.lineno)
+        self.stage_count_dic[name] = self.stage_count_dic.get(name, 0) + count
+
+    def report(self, title=""):
+        if not self.enabled:
+            return
+        print(f"Device syncs {title}: " + ", ".join(f"{name}: {count}" for name, count in self.stage_count_dic.items()))
+        self.stage_count_dic = {}
+
+
+sync_counter = DeviceSyncCounter()
 
 
 class Logger(object):